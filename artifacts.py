@@ -0,0 +1,222 @@
+# # VERSIONED ARTIFACT STORE
+# Feature tables and fitted models are stored under bk/artifacts/<name>/v<version>/ with a manifest.json
+# of the schema and the sha256 of the content. Tables are Arrow IPC files, uncompressed so that they are
+# memory-mapped on load: reading a few columns or a range of rows only converts those to pandas.
+# Models are pickled next to the schema of the features they were fitted on.
+#
+#   save_table(loans, 'loan_data')
+#   load_table('loan_data', columns=['amount', 'duration'], rows=(0, 1000))
+#   save_model(ensemble, 'credit_ensemble', X_ens)
+#   model, features = load_model('credit_ensemble')
+import os
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+ARTIFACT_DIR = 'bk/artifacts'
+
+# rows per record batch of the table files
+BATCH_ROWS = 65536
+
+MANIFEST = 'manifest.json'
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def versions(name, root=ARTIFACT_DIR):
+    """
+    Returns the stored versions of an artifact in ascending order.
+    """
+    path = os.path.join(root, name)
+    if not os.path.isdir(path):
+        return []
+    return sorted(int(entry[1:]) for entry in os.listdir(path)
+                  if entry.startswith('v') and entry[1:].isdigit()
+                  and os.path.exists(os.path.join(path, entry, MANIFEST)))
+
+
+def resolve(path, version=None):
+    """
+    Returns the directory of a version of an artifact, the latest if
+    version is None. path is the directory of the artifact or of one
+    of its versions.
+    """
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        return path
+    stored = versions(os.path.basename(os.path.normpath(path)), os.path.dirname(os.path.normpath(path)))
+    if version is None and stored:
+        version = stored[-1]
+    if version not in stored:
+        raise FileNotFoundError('No version {} of the artifact {}'.format(version, path))
+    return os.path.join(path, 'v{}'.format(version))
+
+
+def read_manifest(path, version=None):
+    with open(os.path.join(resolve(path, version), MANIFEST)) as file:
+        return json.load(file)
+
+
+def schema(frame):
+    return [{'name': str(col), 'dtype': str(dtype)} for col, dtype in frame.dtypes.items()]
+
+
+def _commit(name, root, tmp, manifest):
+    """
+    Moves the files written to tmp into the next version of the
+    artifact, unless the content equals that of the latest version.
+    Returns the version.
+    """
+    stored = versions(name, root)
+    if stored:
+        latest = read_manifest(os.path.join(root, name), stored[-1])
+        if latest['sha256'] == manifest['sha256']:
+            shutil.rmtree(tmp)
+            return stored[-1]
+    manifest['version'] = stored[-1] + 1 if stored else 1
+    manifest['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    with open(os.path.join(tmp, MANIFEST), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.rename(tmp, os.path.join(root, name, 'v{}'.format(manifest['version'])))
+    return manifest['version']
+
+
+def _tmp_dir(name, root):
+    path = os.path.join(root, name, '.tmp-{}'.format(os.getpid()))
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+
+def save_table(frame, name, root=ARTIFACT_DIR):
+    """
+    Stores a DataFrame as a new version of the table name and returns
+    the version. A frame equal to the latest version is not stored again.
+    """
+    tmp = _tmp_dir(name, root)
+    if pa is None:
+        #without pyarrow the table is pickled and read whole
+        path, fmt = os.path.join(tmp, 'data.pkl'), 'pickle'
+        with open(path, 'wb') as file:
+            pickle.dump(frame, file)
+    else:
+        path, fmt = os.path.join(tmp, 'data.arrow'), 'arrow'
+        table = pa.Table.from_pandas(frame, preserve_index=True)
+        with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=BATCH_ROWS)
+    manifest = {'name': name, 'kind': 'table', 'format': fmt, 'file': os.path.basename(path),
+                'sha256': file_hash(path), 'rows': len(frame),
+                'index': [str(level) for level in frame.index.names], 'schema': schema(frame)}
+    return _commit(name, root, tmp, manifest)
+
+
+def _row_range(rows, n):
+    if rows is None:
+        return 0, n
+    start, stop, _ = (rows if isinstance(rows, slice) else slice(*rows)).indices(n)
+    return start, max(start, stop)
+
+
+def read_table(path, version=None, columns=None, rows=None, verify=False):
+    """
+    Reads a version of a table artifact from its directory, see
+    load_table.
+    """
+    path = resolve(path, version)
+    manifest = read_manifest(path)
+    data_path = os.path.join(path, manifest['file'])
+    if verify and file_hash(data_path) != manifest['sha256']:
+        raise ValueError('Content of {} does not match its manifest'.format(data_path))
+    start, stop = _row_range(rows, manifest['rows'])
+
+    if manifest['format'] == 'pickle':
+        with open(data_path, 'rb') as file:
+            frame = pickle.load(file)
+        frame = frame.iloc[start:stop]
+        return frame if columns is None else frame[columns]
+
+    table = pa.ipc.open_file(pa.memory_map(data_path)).read_all()
+    if columns is not None:
+        #the index is stored in columns of its own and kept with any projection
+        index = [col for col in table.schema.pandas_metadata['index_columns'] if isinstance(col, str)]
+        missing = [col for col in columns if col not in table.column_names]
+        if missing:
+            raise KeyError('Unknown columns {}'.format(missing))
+        table = table.select(index + [col for col in columns if col not in index])
+    return table.slice(start, stop - start).to_pandas()
+
+
+def load_table(name, version=None, columns=None, rows=None, root=ARTIFACT_DIR, verify=False):
+    """
+    Loads a table artifact, the latest version if version is None.
+
+    columns = names of the columns to read, all if None
+    rows = (start, stop) or slice of the rows to read, all if None
+    verify = check the content against the hash of the manifest
+    """
+    return read_table(os.path.join(root, name), version, columns, rows, verify)
+
+
+def table_chunks(path, chunksize, columns=None, version=None):
+    """
+    Yields a table artifact in chunks of chunksize rows, each read as
+    a row range of the memory-mapped file.
+    """
+    n = read_manifest(path, version)['rows']
+    for start in range(0, n, chunksize):
+        yield read_table(path, version, columns, (start, start + chunksize))
+
+
+def save_model(model, name, features, table=None, root=ARTIFACT_DIR):
+    """
+    Stores a fitted model as a new version of name with the schema of
+    its features and returns the version.
+
+    features = DataFrame the model was fitted on, or the feature names
+    table = (name, version) of the feature table artifact the model was fitted on
+    """
+    tmp = _tmp_dir(name, root)
+    path = os.path.join(tmp, 'model.pkl')
+    with open(path, 'wb') as file:
+        pickle.dump(model, file)
+    if isinstance(features, pd.DataFrame):
+        features = schema(features)
+    else:
+        features = [{'name': str(col), 'dtype': None} for col in features]
+    manifest = {'name': name, 'kind': 'model', 'format': 'pickle', 'file': 'model.pkl',
+                'sha256': file_hash(path), 'model': type(model).__name__, 'features': features,
+                'table': None if table is None else {'name': table[0], 'version': table[1]}}
+    return _commit(name, root, tmp, manifest)
+
+
+def read_model(path, version=None):
+    """
+    Reads a version of a model artifact from its directory and returns
+    the model and the names of its features, in order.
+    """
+    path = resolve(path, version)
+    manifest = read_manifest(path)
+    with open(os.path.join(path, manifest['file']), 'rb') as file:
+        model = pickle.load(file)
+    return model, [feature['name'] for feature in manifest['features']]
+
+
+def load_model(name, version=None, root=ARTIFACT_DIR):
+    """
+    Loads a model artifact, the latest version if version is None,
+    and returns the model and the names of its features.
+    """
+    return read_model(os.path.join(root, name), version)
@@ -0,0 +1,172 @@
+# # BATCH SCORING
+# Scores a feature table with a persisted model and writes the default probabilities chunk by chunk.
+# The input is read in chunks and the constituent models of a CreditEnsemble are evaluated in a pool
+# of workers, each holding its own copy of the model, so that throughput scales with the worker count.
+#
+#   python batch_score.py bk/artifacts/credit_ensemble bk/artifacts/loan_features scores.csv --chunksize 50000
+import os
+import sys
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from scoring_service import load_model
+
+# model loaded once per worker process
+_model = None
+
+
+def _init_worker(path):
+    global _model
+    _model, _ = load_model(path)
+
+
+def _score_part(X, i=None):
+    """
+    Returns the default probabilities of model i of the ensemble,
+    or of the whole model if i is None.
+    """
+    model = _model if i is None else _model.models[i]
+    return model.predict_proba(X)[:,1]
+
+
+def read_chunks(path, chunksize):
+    """
+    Yields the input table in chunks of chunksize rows. Table artifacts
+    of artifacts.py are read a row range at a time, Parquet and CSV
+    inputs are streamed, pickled DataFrames are sliced.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if os.path.isdir(path):
+        import artifacts
+        yield from artifacts.table_chunks(path, chunksize)
+    elif ext == '.parquet':
+        import pyarrow.parquet as pq
+        file = pq.ParquetFile(path)
+        #batches do not restore the pandas index, set it from the file metadata
+        metadata = file.schema_arrow.pandas_metadata or {}
+        index = metadata.get('index_columns', [])
+        offset = 0
+        for batch in file.iter_batches(batch_size=chunksize):
+            chunk = batch.to_pandas()
+            if index and isinstance(index[0], dict):
+                #a RangeIndex is stored as metadata only
+                step = index[0]['step']
+                start = index[0]['start'] + step * offset
+                chunk.index = pd.RangeIndex(start, start + step * len(chunk), step, name=index[0]['name'])
+            elif index:
+                chunk = chunk.set_index(index)
+            offset += len(chunk)
+            yield chunk
+    elif ext == '.csv':
+        for chunk in pd.read_csv(path, chunksize=chunksize):
+            yield chunk
+    else:
+        data = pd.read_pickle(path)
+        for start in range(0, len(data), chunksize):
+            yield data.iloc[start:start + chunksize]
+
+
+class ScoreWriter:
+    """
+    Appends scored chunks to a CSV or Parquet file.
+    """
+    def __init__(self, path, id_column):
+        self.path = path
+        self.id_column = id_column
+        self.parquet = os.path.splitext(path)[1].lower() == '.parquet'
+        self.writer = None
+        self.rows = 0
+
+    def write(self, ids, probs):
+        frame = pd.DataFrame({self.id_column: ids, 'probability': probs})
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        else:
+            frame.to_csv(self.path, mode='w' if self.rows == 0 else 'a', header=self.rows == 0, index=False)
+        self.rows += len(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def score_file(model_path, input_path, output_path, chunksize=10000, workers=None,
+               threads=False, id_column=None):
+    """
+    Scores input_path with the persisted model in model_path and writes
+    the probabilities to output_path. Ensembles are split into one task
+    per constituent model and chunk, other models into one task per
+    chunk. At most two chunks per worker are in flight, so memory is
+    bounded by the chunk size. Returns the number of rows scored.
+    """
+    workers = workers or os.cpu_count()
+    model, columns = load_model(model_path)
+    ensemble = hasattr(model, 'models') and hasattr(model, 'num_col_og')
+
+    if threads:
+        #threads share the model loaded here
+        global _model
+        _model = model
+        pool = ThreadPoolExecutor(workers)
+    else:
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(model_path,))
+
+    writer = None
+    pending = deque()
+
+    def flush(limit):
+        while len(pending) > limit:
+            ids, futures = pending.popleft()
+            probs = np.mean([future.result() for future in futures], axis=0)
+            writer.write(ids, probs)
+
+    with pool:
+        for chunk in read_chunks(input_path, chunksize):
+            if id_column is not None and id_column in chunk:
+                ids = chunk[id_column].values
+                chunk = chunk.drop(id_column, axis=1)
+            else:
+                ids = chunk.index.values
+            if writer is None:
+                writer = ScoreWriter(output_path, id_column or chunk.index.name or 'index')
+            X = np.asarray(chunk[columns] if columns is not None else chunk, dtype=float)
+
+            if ensemble:
+                X_og, X_dfs = X[:,:model.num_col_og], X[:,model.num_col_og:]
+                futures = [pool.submit(_score_part, X_dfs if dfs else X_og, i)
+                           for i, dfs in enumerate(model.dfs)]
+            else:
+                futures = [pool.submit(_score_part, X)]
+            pending.append((ids, futures))
+            flush(2 * workers)
+        if writer is not None:
+            flush(0)
+            writer.close()
+    return 0 if writer is None else writer.rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Score a feature table with a pickled model.')
+    parser.add_argument('model', help='model artifact or pickled model, e.g. bk/artifacts/credit_ensemble')
+    parser.add_argument('input', help='table artifact, .parquet, .csv or a pickled DataFrame')
+    parser.add_argument('output', help='output .csv or .parquet of probabilities')
+    parser.add_argument('--chunksize', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=None, help='defaults to the number of cores')
+    parser.add_argument('--threads', action='store_true', help='use threads instead of processes')
+    parser.add_argument('--id-column', default=None, help='input column to write next to the probabilities')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    rows = score_file(args.model, args.input, args.output, args.chunksize, args.workers,
+                      args.threads, args.id_column)
+    elapsed = time.perf_counter() - start
+    print('Scored {} rows in {:.1f} s ({:.0f} rows/s)'.format(rows, elapsed, rows / max(elapsed, 1e-9)),
+          file=sys.stderr)
@@ -0,0 +1,98 @@
+# # SCALING BENCHMARK
+# Runs the data preparation on synthetic Berka data at several scales and reports the wall time and
+# peak resident memory of the stages that pipeline.py records. Every scale and output runs in a fresh
+# process, as the scripts do, so that the memoized stages and the memory of one run do not affect the next.
+#
+#   python benchmark.py --scales 1 10 100 --dir bench --out bench_results.json
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import shutil
+
+# stages recorded by pipeline.py, reported for each scale
+STAGES = ['ingest', 'static merge', 'get_dummies', 'groupby mean', 'transaction pass',
+          'transaction pass/read trans', 'transaction pass/merge loan dates', 'transaction pass/prep trans',
+          'transaction pass/aggregate',
+          'partitioned transaction pass', 'ts features', 'finalize aggregates', 'final merge',
+          'dump loan_data', 'dump dfs_data_trans']
+
+# outputs built in a process of their own, as by the scripts that build them
+TARGETS = ['loan_data', 'dfs_data_trans']
+
+
+def run_stages(data_dir, out_dir, target='loan_data', workers=1):
+    """
+    Builds an output of pipeline.py from the Berka tables in data_dir,
+    as credit_risk_datagen.py or dfs_prep.py does, writing the cache
+    and the artifacts into out_dir. Returns the stages recorded by the
+    pipeline and the rows of the output. Must run in a fresh process,
+    since the pipeline stages are memoized.
+    """
+    import instrument
+    import berka_cache
+    berka_cache.DATA_DIR = data_dir
+    berka_cache.CACHE_DIR = os.path.join(out_dir, 'cache')
+    shutil.rmtree(berka_cache.CACHE_DIR, ignore_errors=True)
+    import pipeline
+    pipeline.WORKERS = workers
+
+    instrument.enable(os.path.join(out_dir, 'profile_report_{}.json'.format(target)))
+    if target == 'loan_data':
+        data = pipeline.build_loan_data()
+    else:
+        pipeline.build_dfs_loans()
+        data = pipeline.build_dfs_trans()
+    pipeline.dump(data, os.path.join(out_dir, target))
+    return instrument.report()['stages'], {'loans': len(pipeline.load_tables()['loan']), target: len(data)}
+
+
+def benchmark(scales, bench_dir='bench', seed=0, workers=1):
+    """
+    Generates the synthetic data of each scale, unless it already
+    exists, and builds each of the TARGETS in a subprocess. Returns
+    one result per scale and target.
+    """
+    from berka_synth import generate
+    results = []
+    for scale in scales:
+        data_dir = os.path.join(bench_dir, 'x{:g}'.format(scale))
+        if not os.path.exists(os.path.join(data_dir, 'trans.asc')):
+            start = time.perf_counter()
+            sizes = generate(data_dir, scale, seed=seed)
+            print('Generated scale {:g} in {:.1f} s: {}'.format(scale, time.perf_counter() - start, sizes),
+                  file=sys.stderr)
+        for target in TARGETS:
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', data_dir, '--target', target,
+                                  '--workers', str(workers)], stdout=subprocess.PIPE, check=True)
+            stages, rows = json.loads(out.stdout)
+            results.append({'scale': scale, 'target': target, 'rows': rows, 'stages': stages})
+            for result in stages:
+                if result['stage'] not in STAGES:
+                    continue
+                print('x{:<6g} {:<15} {:<34} {:8.2f} s {:9.0f} MB'.format(
+                    scale, target, result['stage'], result['seconds'], result['peak_rss_mb']), file=sys.stderr)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic data.')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 10])
+    parser.add_argument('--dir', default='bench', help='directory of the generated data')
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the transaction pass')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--target', default='loan_data', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        #child process of a single scale and target
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        json.dump(run_stages(args.run, args.run, args.target, args.workers), sys.stdout)
+    else:
+        results = benchmark(args.scales, args.dir, args.seed, args.workers)
+        with open(args.out, 'w') as file:
+            json.dump(results, file, indent=2)
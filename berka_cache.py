@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+DATA_DIR = 'bk/data_berka'
+CACHE_DIR = 'bk/cache'
+
+# date columns stored as integers in %y%m%d format
+DATE_COLUMNS = {'account': ['date'], 'loan': ['date'], 'trans': ['date']}
+
+# low cardinality string columns of the transactions
+CATEGORY_COLUMNS = {'trans': ['type', 'operation', 'k_symbol']}
+
+
+def parse_table(name, table):
+    """
+    Converts a table read from the .asc file into the types
+    used by the pipeline: dates are parsed, the transaction
+    categories are made categorical and integers downcast.
+    """
+    for col in DATE_COLUMNS.get(name, []):
+        if col in table:
+            table[col] = pd.to_datetime(table[col], format='%y%m%d')
+    for col in CATEGORY_COLUMNS.get(name, []):
+        if col in table:
+            table[col] = table[col].astype('category')
+    if name == 'card':
+        table['issued'] = pd.to_datetime(table.issued.str[:6], format='%y%m%d')
+    for col in table.select_dtypes('integer').columns:
+        table[col] = pd.to_numeric(table[col], downcast='integer')
+    return table
+
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cache_path(name):
+    """
+    Returns the path of the up to date cache of the table, parsing
+    the .asc file and writing the cache first if the source has
+    changed. Files with a new mtime but the same hash are not reparsed.
+    """
+    source = os.path.join(DATA_DIR, name + '.asc')
+    path = os.path.join(CACHE_DIR, name + '.feather')
+    meta_path = os.path.join(CACHE_DIR, name + '.json')
+    stat = os.stat(source)
+    meta = {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path) as file:
+            cached = json.load(file)
+        if cached['size'] == meta['size'] and cached['mtime'] == meta['mtime']:
+            return path
+        meta['hash'] = file_hash(source)
+        if cached.get('hash') == meta['hash']:
+            with open(meta_path, 'w') as file:
+                json.dump(meta, file)
+            return path
+
+    table = parse_table(name, pd.read_csv(source, sep=';'))
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    #uncompressed so that the cache can be memory-mapped
+    feather.write_feather(table, path, compression='uncompressed')
+    meta['hash'] = meta.get('hash') or file_hash(source)
+    with open(meta_path, 'w') as file:
+        json.dump(meta, file)
+    return path
+
+
+def read_table(name, columns=None):
+    """
+    Reads a parsed Berka table, e.g. read_table('loan'). Without
+    pyarrow the table is parsed from the .asc file on every call.
+    """
+    if pa is None:
+        table = parse_table(name, pd.read_csv(os.path.join(DATA_DIR, name + '.asc'), sep=';'))
+        return table if columns is None else table[columns]
+    return feather.read_table(cache_path(name), columns=columns, memory_map=True).to_pandas()
+
+
+def split_cache(name, column, parts):
+    """
+    Splits the cache of a parsed table in one pass into a cache per
+    part, holding the rows with the column in parts[i] in their order
+    in the table. Rows in no part are dropped. The part caches are
+    rewritten only when the table or the parts change. Returns their
+    paths, to be read with read_chunks(..., path=).
+
+    parts = list of arrays of values of the column, disjoint
+    """
+    source = cache_path(name)
+    with open(os.path.join(CACHE_DIR, name + '.json')) as file:
+        key = hashlib.sha1(json.load(file)['hash'].encode())
+    for values in parts:
+        key.update(pd.util.hash_array(np.sort(np.asarray(values))).tobytes())
+    key.update(str(len(parts)).encode())
+    prefix = '{}.{}.part'.format(name, key.hexdigest()[:12])
+    paths = [os.path.join(CACHE_DIR, '{}{}.feather'.format(prefix, i)) for i in range(len(parts))]
+    if all(os.path.exists(path) for path in paths):
+        return paths
+
+    table = feather.read_table(source, memory_map=True)
+    #part of each value of the column, -1 for values in no part
+    values = np.concatenate([np.asarray(part) for part in parts])
+    labels = np.concatenate([np.full(len(part), i) for i, part in enumerate(parts)])
+    lookup = pd.Series(labels, index=values)
+    sinks = [pa.OSFile(path + '.tmp', 'wb') for path in paths]
+    writers = [pa.ipc.new_file(sink, table.schema) for sink in sinks]
+    try:
+        for batch in table.to_batches():
+            part = lookup.reindex(batch.column(column).to_numpy()).fillna(-1).values.astype(np.int64)
+            for i, writer in enumerate(writers):
+                rows = np.flatnonzero(part == i)
+                if len(rows):
+                    writer.write_batch(batch.take(pa.array(rows)))
+    finally:
+        for writer, sink in zip(writers, sinks):
+            writer.close()
+            sink.close()
+    #the parts of other tables or partitions are stale
+    for entry in os.listdir(CACHE_DIR):
+        if entry.startswith(name + '.') and '.part' in entry and not entry.startswith(prefix):
+            os.remove(os.path.join(CACHE_DIR, entry))
+    for path in paths:
+        os.replace(path + '.tmp', path)
+    return paths
+
+
+def read_chunks(name, chunksize, columns=None, where=None, path=None):
+    """
+    Yields a parsed Berka table in chunks of at most chunksize rows.
+    Only the rows of the current chunk are converted to pandas.
+    where = (column, values) keeps only the rows with the column in
+    values, filtered before the conversion. The chunks are the same
+    row ranges of the table with and without the filter.
+    path = cache to read instead of that of the table, e.g. a part of
+    split_cache
+    """
+    if pa is None:
+        reader = pd.read_csv(os.path.join(DATA_DIR, name + '.asc'), sep=';',
+                             chunksize=chunksize, usecols=columns)
+        for chunk in reader:
+            if where is not None:
+                chunk = chunk[chunk[where[0]].isin(where[1])]
+            yield parse_table(name, chunk)
+        return
+    table = feather.read_table(path or cache_path(name), columns=columns, memory_map=True)
+    if where is not None:
+        values = pa.array(where[1], type=table.schema.field(where[0]).type)
+    for batch in table.to_batches(max_chunksize=chunksize):
+        if where is not None:
+            batch = batch.filter(pc.is_in(batch.column(where[0]), value_set=values))
+        yield batch.to_pandas()
@@ -0,0 +1,169 @@
+# # SYNTHETIC BERKA DATA
+# Writes random tables in the schema of the Berka .asc files, so that the pipeline can be run at sizes
+# beyond the bundled data. scale=1 is about the size of the bundled data: 4500 accounts, 680 loans
+# and 1M transactions. The transactions are written in blocks of accounts, so memory use does not
+# grow with the scale.
+#
+#   python berka_synth.py bench/x10 10
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+ACCOUNTS = 4500
+
+# accounts per block of generated transactions
+BLOCK = 20000
+
+# transactions end at the end of the data period
+END = pd.Timestamp('1998-12-31')
+
+# transaction kinds as (operation, k_symbol, credit, probability)
+KINDS = [('VYBER', None, False, 0.3), ('VKLAD', None, True, 0.15), (None, 'UROK', True, 0.13),
+         ('PREVOD NA UCET', 'SIPO', False, 0.07), ('PREVOD Z UCTU', None, True, 0.06),
+         ('PREVOD NA UCET', ' ', False, 0.1), ('VYBER', 'SLUZBY', False, 0.08),
+         ('VYBER KARTOU', None, False, 0.08), (None, 'SANKC. UROK', False, 0.01),
+         ('PREVOD NA UCET', 'POJISTNE', False, 0.02)]
+
+
+def yymmdd(dates):
+    return (dates.year % 100) * 10000 + dates.month * 100 + dates.day
+
+
+def static_tables(rng, n_accounts, loan_share):
+    """
+    Returns the district, account, disp, client, card, order and loan
+    tables and the opening dates of the accounts.
+    """
+    n_districts = 77
+    district = pd.DataFrame({'A1': np.arange(1, n_districts + 1)})
+    district['A2'] = ['District %d' % i for i in district.A1]
+    district['A3'] = rng.choice(['Prague', 'central Bohemia', 'south Moravia', 'north Moravia'], n_districts)
+    district['A4'] = rng.integers(40000, 1200000, n_districts)
+    for col in ['A5', 'A6', 'A7', 'A8', 'A9']:
+        district[col] = rng.integers(0, 60, n_districts)
+    district['A10'] = rng.uniform(30, 100, n_districts).round(1)
+    district['A11'] = rng.integers(8000, 13000, n_districts)
+    district['A12'] = rng.uniform(0, 7, n_districts).round(2).astype(str)
+    district['A13'] = rng.uniform(0, 9, n_districts).round(2)
+    district['A14'] = rng.integers(80, 170, n_districts)
+    district['A15'] = rng.integers(800, 90000, n_districts).astype(str)
+    district['A16'] = rng.integers(800, 100000, n_districts)
+    #the original data misses the 1995 statistics of one district
+    district.loc[68, ['A12', 'A15']] = '?'
+
+    account_dates = pd.Timestamp('1993-01-01') + pd.to_timedelta(rng.integers(0, 1400, n_accounts), 'D')
+    account = pd.DataFrame({'account_id': np.arange(1, n_accounts + 1),
+                            'district_id': rng.integers(1, n_districts + 1, n_accounts),
+                            'frequency': rng.choice(['POPLATEK MESICNE', 'POPLATEK TYDNE', 'POPLATEK PO OBRATU'],
+                                                    n_accounts, p=[0.9, 0.05, 0.05]),
+                            'date': yymmdd(account_dates)})
+
+    #one owner per account and a disponent for some
+    disponent = rng.random(n_accounts) < 0.2
+    disp_accounts = np.concatenate([account.account_id.values, account.account_id.values[disponent]])
+    n_clients = len(disp_accounts)
+    disp = pd.DataFrame({'disp_id': np.arange(1, n_clients + 1), 'client_id': np.arange(1, n_clients + 1),
+                         'account_id': disp_accounts,
+                         'type': ['OWNER'] * n_accounts + ['DISPONENT'] * int(disponent.sum())})
+
+    #birth numbers are yymmdd with 50 added to the month of women
+    birth = pd.Timestamp('1930-01-01') + pd.to_timedelta(rng.integers(0, 365 * 50, n_clients), 'D')
+    female = rng.random(n_clients) < 0.5
+    birth_number = (birth.year % 100) * 10000 + (birth.month + 50 * female) * 100 + birth.day
+    client = pd.DataFrame({'client_id': disp.client_id, 'birth_number': birth_number,
+                           'district_id': rng.integers(1, n_districts + 1, n_clients)})
+
+    card_disp = disp.disp_id[rng.random(n_clients) < 0.15].values
+    card_dates = pd.Timestamp('1993-06-01') + pd.to_timedelta(rng.integers(0, 2000, len(card_disp)), 'D')
+    card = pd.DataFrame({'card_id': np.arange(1, len(card_disp) + 1), 'disp_id': card_disp,
+                         'type': rng.choice(['classic', 'junior', 'gold'], len(card_disp), p=[0.9, 0.05, 0.05]),
+                         'issued': card_dates.strftime('%y%m%d') + ' 00:00:00'})
+
+    order = pd.DataFrame({'order_id': np.arange(1, n_accounts + 1),
+                          'account_id': rng.choice(account.account_id, n_accounts),
+                          'bank_to': rng.choice(['AB', 'CD', 'EF', 'GH'], n_accounts),
+                          'account_to': rng.integers(10 ** 7, 10 ** 8, n_accounts),
+                          'amount': rng.uniform(100, 10000, n_accounts).round(1),
+                          'k_symbol': rng.choice(['SIPO', 'UVER', 'POJISTNE', ' '], n_accounts)})
+
+    #loans are given on accounts at least a year old. The ids start as in the
+    #original data, pipeline.loan_features uses loan 5281, so there are at least 400.
+    n_loans = max(int(n_accounts * loan_share), 400)
+    loan_accounts = rng.choice(account.account_id, n_loans, replace=False)
+    loan_dates = account_dates[loan_accounts - 1] + pd.to_timedelta(rng.integers(365, 1000, n_loans), 'D')
+    duration = rng.choice([12, 24, 36, 48, 60], n_loans)
+    amount = rng.integers(5000, 500000, n_loans)
+    loan = pd.DataFrame({'loan_id': 4959 + np.arange(n_loans), 'account_id': loan_accounts,
+                         'date': yymmdd(loan_dates), 'amount': amount, 'duration': duration,
+                         'payments': (amount / duration).round(1),
+                         'status': rng.choice(['A', 'B', 'C', 'D'], n_loans, p=[0.3, 0.05, 0.6, 0.05])})
+
+    tables = {'district': district, 'account': account, 'disp': disp, 'client': client,
+              'card': card, 'order': order, 'loan': loan}
+    return tables, account_dates
+
+
+def trans_block(rng, account_ids, account_dates, trans_per_month, first_id):
+    """
+    Returns the transactions of a block of accounts from the account
+    opening until the end of the data period, sorted by date.
+    """
+    days = (END - account_dates).days.values
+    n_trans = rng.poisson(np.maximum(days // 30, 1) * trans_per_month)
+    accounts = np.repeat(account_ids, n_trans)
+    dates = np.repeat(account_dates.values, n_trans) + \
+        pd.to_timedelta(rng.integers(0, np.repeat(days, n_trans) + 1), 'D').values
+    n = len(accounts)
+
+    operation, k_symbol, credit, p = map(np.array, zip(*KINDS))
+    kind = rng.choice(len(KINDS), n, p=p.astype(float))
+    amount = rng.lognormal(7.5, 1.2, n).round(1)
+    interest = kind == 2
+    amount[interest] = rng.uniform(10, 300, interest.sum()).round(1)
+
+    trans = pd.DataFrame({'account_id': accounts, 'date': dates, 'credit': credit[kind].astype(bool),
+                          'operation': operation[kind], 'amount': amount, 'k_symbol': k_symbol[kind]})
+    trans = trans.sort_values(['account_id', 'date'], kind='mergesort')
+    signed = np.where(trans.credit, trans.amount, -trans.amount)
+    trans['balance'] = (pd.Series(signed, index=trans.index).groupby(trans.account_id).cumsum() + 1000).round(1)
+    trans = trans.sort_values('date', kind='mergesort')
+
+    trans.insert(0, 'trans_id', np.arange(first_id, first_id + n))
+    trans['type'] = np.where(trans.credit, 'PRIJEM', 'VYDAJ')
+    trans['date'] = yymmdd(pd.DatetimeIndex(trans.date))
+    trans['bank'] = None
+    trans['account'] = None
+    return trans[['trans_id', 'account_id', 'date', 'type', 'operation', 'amount', 'balance',
+                  'k_symbol', 'bank', 'account']]
+
+
+def generate(out, scale=1, loan_share=0.15, trans_per_month=4.7, seed=0):
+    """
+    Writes the Berka tables at the given scale into the directory out.
+    Returns the number of rows written per table.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out, exist_ok=True)
+    n_accounts = max(int(ACCOUNTS * scale), 1)
+
+    tables, account_dates = static_tables(rng, n_accounts, loan_share)
+    rows = {}
+    for name, table in tables.items():
+        table.to_csv(os.path.join(out, name + '.asc'), sep=';', index=False)
+        rows[name] = len(table)
+
+    path = os.path.join(out, 'trans.asc')
+    rows['trans'] = 0
+    for start in range(0, n_accounts, BLOCK):
+        account_ids = np.arange(start + 1, min(start + BLOCK, n_accounts) + 1)
+        trans = trans_block(rng, account_ids, account_dates[start:start + BLOCK], trans_per_month,
+                            rows['trans'] + 1)
+        trans.to_csv(path, sep=';', index=False, mode='w' if start == 0 else 'a', header=start == 0)
+        rows['trans'] += len(trans)
+    return rows
+
+
+if __name__ == "__main__":
+    rows = generate(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 1)
+    print(rows)
@@ -1,15 +1,147 @@
+import os
+import pickle
 import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.model_selection import learning_curve
+from joblib import hash as data_hash
+from sklearn.base import BaseEstimator, ClassifierMixin, clone, is_classifier
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import check_cv
+from sklearn.utils import _safe_indexing
+from sklearn.utils.metaestimators import available_if
 from matplotlib.lines import Line2D
 import pandas as pd
+import fit_pool
+
+# fitted predictions of the learning curves, keyed by estimator, data, folds and train sizes
+CACHE_DIR = 'bk/eval_cache'
+
+
+class CachedPredictions(ClassifierMixin, BaseEstimator):
+    """
+    Stands in for a fitted estimator when scoring, returning the
+    predictions the estimator made on the scored sample, so that any
+    number of scorers is computed from a single fit. Only the methods
+    of the estimator are available, so that scorers pick the same
+    method as they would on the estimator.
+    """
+    def __init__(self, predictions=None, classes=None):
+        self.predictions = predictions
+        self.classes = classes
+
+    @property
+    def classes_(self):
+        return self.classes
+
+    def predict(self, X):
+        return self.predictions['predict']
+
+    @available_if(lambda self: 'predict_proba' in self.predictions)
+    def predict_proba(self, X):
+        return self.predictions['predict_proba']
+
+    @available_if(lambda self: 'decision_function' in self.predictions)
+    def decision_function(self, X):
+        return self.predictions['decision_function']
+
+
+def _predict(estimator, X):
+    return {method: getattr(estimator, method)(X)
+            for method in ['predict', 'predict_proba', 'decision_function'] if hasattr(estimator, method)}
+
+
+def _fit_predict(estimator, train, test):
+    """
+    Fits a clone of the estimator on the train rows and returns its
+    predictions on the train and test rows.
+    """
+    X_train, y_train = fit_pool.rows(train)
+    estimator = clone(estimator).fit(X_train, y_train)
+    return {'classes': getattr(estimator, 'classes_', None),
+            'train': _predict(estimator, X_train),
+            'test': _predict(estimator, fit_pool.rows(test)[0])}
+
+
+def train_sizes_abs(train_sizes, n_max):
+    #fractions of the train set of the first fold, as in sklearn learning_curve
+    train_sizes = np.asarray(train_sizes)
+    if np.issubdtype(train_sizes.dtype, np.floating) and train_sizes.max() <= 1:
+        train_sizes = (train_sizes * n_max).astype(int)
+    return np.unique(np.clip(train_sizes, 1, n_max))
+
+
+def fit_learning_curve(estimator, X, y, cv=None, train_sizes=np.linspace(.1, 1.0, 5), n_jobs=None,
+                       cache_dir=CACHE_DIR):
+    """
+    Fits the estimator once for each train size and fold, as in sklearn
+    learning_curve. Returns the absolute train sizes, the (train, test)
+    rows of each fit and the predictions of the fits on their train and
+    test rows, as a list of lists by train size and fold. The fits
+    run in a pool of n_jobs processes and are memoized in cache_dir,
+    keyed by a hash of the estimator parameters, the data, the folds
+    and the train sizes.
+    """
+    cv = check_cv(cv, y, classifier=is_classifier(estimator))
+    folds = list(cv.split(X, y))
+    sizes = train_sizes_abs(train_sizes, len(folds[0][0]))
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, data_hash((clone(estimator), X, y, folds, sizes)))
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                return pickle.load(file)
+
+    tasks = [(train[:n_train], test) for n_train in sizes for train, test in folds]
+    pool = fit_pool.data_pool(X, y, n_jobs)
+    if pool is not None:
+        with pool:
+            fits = list(pool.map(_fit_predict, [estimator] * len(tasks), *zip(*tasks)))
+    else:
+        fits = [_fit_predict(estimator, train, test) for train, test in tasks]
+    fits = [fits[i:i + len(folds)] for i in range(0, len(fits), len(folds))]
+    result = (sizes, tasks, fits)
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path, 'wb') as file:
+            pickle.dump(result, file)
+    return result
+
+
+def evaluate_learning_curve(estimator, X, y, cv=None, train_sizes=np.linspace(.1, 1.0, 5),
+                            scoring=None, n_jobs=None, cache_dir=CACHE_DIR):
+    """
+    Computes learning curves for several scorers from one set of fits.
+    scoring is a dict of name: scorer, a None scorer is the estimator's
+    score method. Returns a dict of name: (train_sizes, train_scores,
+    test_scores), as returned by sklearn learning_curve.
+    """
+    sizes, tasks, fits = fit_learning_curve(estimator, X, y, cv, train_sizes, n_jobs, cache_dir)
+    curves = {}
+    for name, scorer in (scoring or {'score': None}).items():
+        scorer = check_scoring(estimator, scorer)
+        train_scores = np.empty((len(sizes), len(fits[0])))
+        test_scores = np.empty_like(train_scores)
+        for i, row in enumerate(fits):
+            for j, fit in enumerate(row):
+                train, test = tasks[i * len(row) + j]
+                train_scores[i, j] = scorer(CachedPredictions(fit['train'], fit['classes']),
+                                            _safe_indexing(X, train), _safe_indexing(y, train))
+                test_scores[i, j] = scorer(CachedPredictions(fit['test'], fit['classes']),
+                                           _safe_indexing(X, test), _safe_indexing(y, test))
+        curves[name] = (sizes, train_scores, test_scores)
+    return curves
+
 
 def plot_learning_curve(estimator, title, X, y, ylim=None, cv=None,
                         n_jobs=None, train_sizes=np.linspace(.1, 1.0, 5), benchmark=None,
-                       scoring=None):
+                       scoring=None, cache_dir=CACHE_DIR):
     """
     Adapted from here:
     http://scikit-learn.org/stable/auto_examples/model_selection/plot_learning_curve.html
+
+    The fits are shared with other calls on the same estimator, data and
+    folds, e.g. the accuracy and Brier score curves fit the models once.
     """
     _, axes = plt.subplots(1, 1, figsize=(17, 12))
     axes.set_title(title, loc='left', size=20)
@@ -20,8 +152,8 @@ def plot_learning_curve(estimator, title, X, y, ylim=None, cv=None,
     axes.set_ylabel("Score", size=15)
 
     train_sizes, train_scores, test_scores = \
-        learning_curve(estimator, X, y, cv=cv, n_jobs=n_jobs,
-                       train_sizes=train_sizes, scoring=scoring)
+        evaluate_learning_curve(estimator, X, y, cv=cv, train_sizes=train_sizes,
+                                scoring={'score': scoring}, n_jobs=n_jobs, cache_dir=cache_dir)['score']
     train_scores_mean = np.mean(train_scores, axis=1)
     train_scores_std = np.std(train_scores, axis=1)
     test_scores_mean = np.mean(test_scores, axis=1)
@@ -54,8 +186,10 @@ def plot_learning_curve(estimator, title, X, y, ylim=None, cv=None,
     lg.set_title(lg.get_title().get_text())
     return plt, test_scores_mean
 
-def fit_importances(estimator, X, y, title):
-    estimator.fit(X, y)
+def fit_importances(estimator, X, y, title, refit=True):
+    #refit=False plots an estimator already fitted on X and y
+    if refit:
+        estimator.fit(X, y)
     if hasattr(estimator, 'coef_'):
         
         #get the non-zero coefficients and respective column names
@@ -76,4 +210,47 @@ def fit_importances(estimator, X, y, title):
     axes.set_title(title, loc='left', size=20)
     axes.set_ylabel('Feature', size = 15)
     plt.show()
-    return plt, df.sort_values('Importance', ascending=False)
\ No newline at end of file
+    return plt, df.sort_values('Importance', ascending=False)
+
+
+def check_learning_curve(estimator, X, y, cv=None, train_sizes=np.linspace(.1, 1.0, 5), scoring=None):
+    """
+    Returns the largest absolute difference between the scores of
+    evaluate_learning_curve and sklearn learning_curve, over the
+    scorers of the scoring dict. A NaN score is a mismatch.
+    """
+    from sklearn.model_selection import learning_curve
+    curves = evaluate_learning_curve(estimator, X, y, cv, train_sizes, scoring, cache_dir=None)
+    diff = 0
+    for name, scorer in (scoring or {'score': None}).items():
+        expected = learning_curve(estimator, X, y, cv=cv, train_sizes=train_sizes, scoring=scorer)
+        for got, want in zip(curves[name], expected):
+            delta = np.abs(np.asarray(got, dtype=float) - np.asarray(want, dtype=float))
+            diff = max(diff, np.inf if np.isnan(delta).any() else delta.max())
+    return diff
+
+
+if __name__ == "__main__":
+    #parity of the cached learning curves with sklearn, exits with an error on a mismatch
+    import sys
+    from sklearn.datasets import make_classification
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.model_selection import StratifiedKFold
+    from credit_models import CreditEnsemble, create_pipeline
+
+    X, y = make_classification(400, 12, random_state=1)
+    X = pd.DataFrame(X, columns=['x{}'.format(i) for i in range(12)])
+    scoring = {name: name for name in ['accuracy', 'roc_auc', 'neg_log_loss', 'neg_brier_score']}
+    estimators = {
+        #decision_function and predict_proba
+        'logistic regression': LogisticRegression(),
+        #predict_proba only
+        'ensemble': CreditEnsemble([create_pipeline(LogisticRegression(), [0, 1]),
+                                    create_pipeline(LogisticRegression(C=0.1), [0])], [False, True], 6)}
+    failed = False
+    for name, estimator in estimators.items():
+        diff = check_learning_curve(estimator, X, y, StratifiedKFold(5), np.linspace(.3, 1.0, 3), scoring)
+        print('{}: max abs difference {:.3g}'.format(name, diff))
+        failed |= diff > 1e-12
+    if failed:
+        sys.exit('learning curves differ from sklearn learning_curve')
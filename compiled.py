@@ -0,0 +1,291 @@
+# # COMPILED SCORING
+# Compiles a fitted create_pipeline model, a bare LogisticRegression or GradientBoostingClassifier, or a
+# CreditEnsemble of them into flat NumPy arrays, so that rows are scored without the DataFrame conversions,
+# column slicing and concatenation of the sklearn pipeline. The scaler is folded into the logistic
+# coefficients, the boosted trees are packed into one set of node arrays and traversed for all trees at once.
+#
+#   python compiled.py bk/artifacts/credit_ensemble bk/artifacts/X_ens --out credit_ensemble.npz
+#
+# checks the compiled probabilities against the model and reports the latencies of both, and
+#
+#   python compiled.py --self-check
+#
+# checks them for models fitted on synthetic data. Both exit with an error when the probabilities differ.
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from scipy.special import expit
+from sklearn.dummy import DummyClassifier
+from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.linear_model import LogisticRegression
+
+
+def scaler_arrays(model, n_features):
+    """
+    Returns the final classifier of a model and the mean, scale and
+    column order of its CustomScaler: column k of the classifier input
+    is column order[k] of X, scaled if k is past the dummy columns.
+    """
+    mean, scale = np.zeros(n_features), np.ones(n_features)
+    order = np.arange(n_features)
+    if not hasattr(model, 'steps'):
+        return model, mean, scale, order
+    scaler = model.steps[0][1]
+    columns = list(scaler.columns)
+    if columns:
+        mean[columns] = scaler.scaler.mean_
+        scale[columns] = scaler.scaler.scale_
+        order = np.array([i for i in range(n_features) if i not in columns] + columns)
+    return model.steps[-1][1], mean, scale, order
+
+
+def compile_linear(clf, mean, scale, order):
+    #w.(x - mean)/scale + b = (w/scale).x + b - w.mean/scale in the order of X
+    coef = np.zeros(len(order))
+    coef[order] = clf.coef_[0]
+    coef = coef / scale
+    return {'kind': 'linear', 'coef': coef, 'intercept': np.array([clf.intercept_[0] - coef.dot(mean)])}
+
+
+def init_score(clf, n_features):
+    """
+    Returns the raw prediction of the constant init estimator of a
+    gradient boosting model: the log odds of its probability, clipped
+    as in sklearn, halved for the exponential loss.
+    """
+    if isinstance(clf.init_, str) and clf.init_ == 'zero':
+        return 0.0
+    if not isinstance(clf.init_, DummyClassifier) or clf.init_.strategy == 'stratified':
+        raise ValueError('Only gradient boosting models with a constant init are compiled')
+    eps = np.finfo(np.float32).eps
+    prob = np.clip(clf.init_.predict_proba(np.zeros((1, n_features)))[0, 1], eps, 1 - eps)
+    raw = np.log(prob / (1 - prob))
+    return raw / 2 if clf.loss == 'exponential' else raw
+
+
+def compile_trees(clf, mean, scale, order):
+    """
+    Packs the regression trees of a binary gradient boosting model into
+    flat node arrays. The children of a leaf are the leaf itself, so
+    that all trees are traversed together for the largest depth.
+    """
+    if clf.estimators_.shape[1] != 1:
+        raise ValueError('Only binary gradient boosting models are compiled')
+    trees = [estimator.tree_ for estimator in clf.estimators_[:, 0]]
+    offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+    left, right, feature, threshold, value = [], [], [], [], []
+    for tree, offset in zip(trees, offsets):
+        nodes = np.arange(tree.node_count)
+        leaf = tree.children_left < 0
+        left.append(np.where(leaf, nodes, tree.children_left) + offset)
+        right.append(np.where(leaf, nodes, tree.children_right) + offset)
+        #the features of the classifier input are columns of X
+        feature.append(np.where(leaf, 0, order[np.maximum(tree.feature, 0)]))
+        threshold.append(np.where(leaf, np.inf, tree.threshold))
+        value.append(tree.value[:, 0, 0])
+
+    init = init_score(clf, len(order))
+    return {'kind': 'trees', 'mean': mean, 'scale': scale, 'roots': offsets[:-1],
+            'left': np.concatenate(left), 'right': np.concatenate(right),
+            'feature': np.concatenate(feature), 'threshold': np.concatenate(threshold),
+            'value': np.concatenate(value) * clf.learning_rate, 'init': np.array([init]),
+            'depth': np.array([max(tree.max_depth for tree in trees)]),
+            'link': np.array([2.0 if clf.loss == 'exponential' else 1.0])}
+
+
+def compile_part(model, n_features):
+    clf, mean, scale, order = scaler_arrays(model, n_features)
+    if isinstance(clf, LogisticRegression):
+        if clf.coef_.shape[0] != 1:
+            raise ValueError('Only binary logistic regressions are compiled')
+        return compile_linear(clf, mean, scale, order)
+    if isinstance(clf, GradientBoostingClassifier):
+        return compile_trees(clf, mean, scale, order)
+    raise ValueError('Cannot compile a {}'.format(type(clf).__name__))
+
+
+def n_features_in(model):
+    clf = model.steps[-1][1] if hasattr(model, 'steps') else model
+    return clf.n_features_in_
+
+
+class CompiledModel:
+    """
+    Default probabilities of a compiled model, the mean of its parts.
+    Part i scores the columns start[i]:stop[i] of X.
+    """
+    def __init__(self, parts, starts, stops, columns=None):
+        self.parts = parts
+        self.starts = starts
+        self.stops = stops
+        self.columns_ = columns
+
+    def _part_proba(self, part, X):
+        if part['kind'] == 'linear':
+            return expit(X.dot(part['coef']) + part['intercept'][0])
+        #the trees compare float32 inputs, as sklearn does
+        X = ((X - part['mean']) / part['scale']).astype(np.float32)
+        rows = np.arange(len(X))[:, None]
+        node = np.broadcast_to(part['roots'], (len(X), len(part['roots'])))
+        for _ in range(int(part['depth'][0])):
+            go_left = X[rows, part['feature'][node]] <= part['threshold'][node]
+            node = np.where(go_left, part['left'][node], part['right'][node])
+        raw = part['init'][0] + part['value'][node].sum(axis=1)
+        return expit(part['link'][0] * raw)
+
+    def predict_prob(self, X):
+        X = np.asarray(X, dtype=float)
+        if X.ndim == 1:
+            X = X[None, :]
+        probs = [self._part_proba(part, X[:, start:stop])
+                 for part, start, stop in zip(self.parts, self.starts, self.stops)]
+        return probs[0] if len(probs) == 1 else np.mean(probs, axis=0)
+
+    def predict_proba(self, X):
+        prob = self.predict_prob(X)
+        return np.column_stack([1 - prob, prob])
+
+    def predict(self, X):
+        return np.round(self.predict_prob(X))
+
+    def save(self, path):
+        """
+        Writes the arrays of the parts to an .npz file.
+        """
+        arrays = {'part{}_{}'.format(i, key): value for i, part in enumerate(self.parts)
+                  for key, value in part.items() if key != 'kind'}
+        meta = {'kinds': [part['kind'] for part in self.parts], 'starts': [int(i) for i in self.starts],
+                'stops': [int(i) for i in self.stops], 'columns': self.columns_}
+        np.savez(path, meta=np.array(json.dumps(meta)), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            parts = []
+            for i, kind in enumerate(meta['kinds']):
+                prefix = 'part{}_'.format(i)
+                part = {key[len(prefix):]: data[key] for key in data.files if key.startswith(prefix)}
+                part['kind'] = kind
+                parts.append(part)
+        return cls(parts, meta['starts'], meta['stops'], meta['columns'])
+
+
+def compile_model(model):
+    """
+    Compiles a fitted create_pipeline model, LogisticRegression,
+    GradientBoostingClassifier or CreditEnsemble of them.
+    """
+    columns = getattr(model, 'columns_', None)
+    if hasattr(model, 'models') and hasattr(model, 'num_col_og'):
+        parts, starts, stops = [], [], []
+        for part, dfs in zip(model.models, model.dfs):
+            n = n_features_in(part)
+            start = model.num_col_og if dfs else 0
+            parts.append(compile_part(part, n))
+            starts.append(start)
+            stops.append(start + n)
+        return CompiledModel(parts, starts, stops, columns)
+    n = n_features_in(model)
+    return CompiledModel([compile_part(model, n)], [0], [n], columns)
+
+
+def latency(predict, X, repeat):
+    """
+    Returns the median seconds of repeat calls of predict on X.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        predict(X)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def check(model, compiled, X, batch_sizes=(1, 32, 1024), repeat=200):
+    """
+    Compares the compiled probabilities with those of the model on X
+    and measures the latency of both for batches of the given sizes.
+    Returns the largest absolute difference and the latencies in
+    milliseconds by batch size.
+    """
+    X = np.asarray(X, dtype=float)
+    diff = np.abs(compiled.predict_proba(X)[:, 1] - model.predict_proba(X)[:, 1]).max()
+    rows = {}
+    for size in batch_sizes:
+        batch = X[np.arange(size) % len(X)]
+        n = max(1, repeat * 32 // max(size, 32))
+        rows[size] = {'sklearn_ms': 1000 * latency(model.predict_proba, batch, n),
+                      'compiled_ms': 1000 * latency(compiled.predict_proba, batch, n)}
+    return diff, rows
+
+
+def self_check():
+    """
+    Compiles models of every supported kind fitted on synthetic data
+    and returns the largest absolute difference of the probabilities
+    by model.
+    """
+    from sklearn.datasets import make_classification
+    from credit_models import CreditEnsemble, create_pipeline
+    X, y = make_classification(600, 10, random_state=1)
+    #integer columns, so that the thresholds of the trees are hit exactly
+    X[:, :2] = np.round(X[:, :2] * 3)
+    models = {
+        'logistic regression': create_pipeline(LogisticRegression(), [0, 1, 2]),
+        'boosting': create_pipeline(GradientBoostingClassifier(n_estimators=50, max_depth=3, random_state=1),
+                                    [2, 3]),
+        'boosting, exponential loss': GradientBoostingClassifier(loss='exponential', n_estimators=30,
+                                                                 random_state=1),
+        'boosting, zero init': GradientBoostingClassifier(init='zero', n_estimators=30, random_state=1),
+        'ensemble': CreditEnsemble([create_pipeline(LogisticRegression(), [0]),
+                                    create_pipeline(GradientBoostingClassifier(n_estimators=20, random_state=1),
+                                                    [0])], [False, True], 4)}
+    diffs = {}
+    for name, model in models.items():
+        model.fit(X, y)
+        compiled = compile_model(model)
+        diffs[name] = np.abs(compiled.predict_proba(X)[:, 1] - model.predict_proba(X)[:, 1]).max()
+    return diffs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compile a fitted model to NumPy arrays and check it.')
+    parser.add_argument('model', nargs='?', help='model artifact or pickled model')
+    parser.add_argument('data', nargs='?', help='table artifact or pickled DataFrame of feature rows to check on')
+    parser.add_argument('--out', default=None, help='.npz file of the compiled model')
+    parser.add_argument('--tolerance', type=float, default=1e-9)
+    parser.add_argument('--self-check', action='store_true', help='check models fitted on synthetic data')
+    args = parser.parse_args()
+
+    if args.self_check:
+        diffs = self_check()
+        for name, diff in diffs.items():
+            print('{}: max abs difference {:.3g}'.format(name, diff))
+        if max(diffs.values()) > args.tolerance:
+            sys.exit('compiled probabilities differ by {:.3g}'.format(max(diffs.values())))
+        sys.exit()
+    if args.model is None or args.data is None:
+        parser.error('give a model and data, or --self-check')
+
+    import pandas as pd
+    import artifacts
+    from scoring_service import load_model
+    model, columns = load_model(args.model)
+    data = artifacts.read_table(args.data) if os.path.isdir(args.data) else pd.read_pickle(args.data)
+    X = data[columns] if columns is not None and set(columns) <= set(data.columns) else data
+    compiled = compile_model(model)
+    if args.out:
+        compiled.save(args.out)
+        compiled = CompiledModel.load(args.out)
+
+    diff, rows = check(model, compiled, X)
+    print('max abs difference {:.3g}'.format(diff))
+    for size, row in rows.items():
+        print('batch {:5d}: sklearn {:8.3f} ms, compiled {:8.3f} ms, {:6.1f}x'.format(
+            size, row['sklearn_ms'], row['compiled_ms'], row['sklearn_ms'] / row['compiled_ms']))
+    if diff > args.tolerance:
+        sys.exit('compiled probabilities differ by {:.3g}'.format(diff))
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin, ClassifierMixin
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+
+class CustomScaler(BaseEstimator,TransformerMixin):
+    """
+    Custom wrapper for the StandardScaler that does not scale
+    dummy variables. This makes for more interpretable coefficients.
+
+    """
+    def __init__(self,columns):
+        self.scaler = StandardScaler()
+        self.columns = columns
+
+    def fit(self, X, y=None):
+        X = pd.DataFrame(np.asarray(X))
+        if len(self.columns)>0:
+            self.scaler.fit(X.iloc[:,self.columns], y)
+        return self
+
+    def transform(self, X, y=None):
+        #positional column names, so that the output does not mix names and positions
+        X = pd.DataFrame(np.asarray(X))
+        mask = [i for i in range(len(X.columns)) if i not in self.columns]
+        X_dummy = X.iloc[:,mask]
+        if len(self.columns)>0:
+            X_cont = pd.DataFrame(self.scaler.transform(X.iloc[:,self.columns]),
+                                  columns=self.columns, index=X.index)
+            frame = pd.concat([X_dummy, X_cont], axis=1)
+        else:
+            frame = X
+        return frame
+
+
+class PipelineRFE(Pipeline):
+        """
+        Wrapper class for pipeline. Captures the coefficients or feature importances
+        from the pipeline.
+        """
+        def fit(self, X, y=None, **fit_params):
+            self.steps[0][1].columns = \
+                [i for i, x in enumerate((np.amin(X, axis=0)!=0)|(np.amax(X, axis=0)!=1)) if x]
+            super(PipelineRFE, self).fit(X, y, **fit_params)
+            clf = self.steps[-1][-1]
+            if hasattr(clf, 'coef_'):
+                self.coef_ = clf.coef_
+            else:
+                self.feature_importances_ = clf.feature_importances_
+            if hasattr(X, 'columns'):
+                self.columns_ = list(X.columns)
+            return self
+
+
+def create_pipeline(classifier, dummies=None):
+    """
+    Function to automatically generate a pipeline to fit with standard scaler
+    """
+    pipe =  [
+        ('std_scaler', CustomScaler(dummies)),
+        ('clf', classifier)
+    ]
+    return(PipelineRFE(pipe))
+
+
+class CreditEnsemble(ClassifierMixin, BaseEstimator):
+    """
+    Ensemble that averages the predicted probabilities of its models.
+    The first num_col_og columns of X are the original features and
+    the rest the deep feature synthesis features. dfs[i] tells which
+    of the two feature sets is used by models[i].
+
+    The class first written in the notebook reset its predictions for
+    every model: predict and predict_prob returned the last model and
+    predict_proba the first. All models are averaged here, so scores
+    differ from the notebook outputs computed with that class.
+    """
+    def __init__(self, models, dfs, num_col_og):
+        self.models = models
+        self.dfs = dfs
+        self.num_col_og = num_col_og
+
+    def _split(self, X):
+        #slice both feature sets once per call instead of once per model
+        if hasattr(X, 'iloc'):
+            return X.iloc[:,:self.num_col_og], X.iloc[:,self.num_col_og:]
+        X = np.asarray(X)
+        return X[:,:self.num_col_og], X[:,self.num_col_og:]
+
+    def fit(self, X, y):
+        X_og, X_dfs = self._split(X)
+        for model, dfs in zip(self.models, self.dfs):
+            model.fit(X_dfs if dfs else X_og, y)
+        self.classes_ = np.unique(y)
+        if hasattr(X, 'columns'):
+            self.columns_ = list(X.columns)
+        return self
+
+    def predict_proba(self, X):
+        X_og, X_dfs = self._split(X)
+        preds = [model.predict_proba(X_dfs if dfs else X_og)
+                 for model, dfs in zip(self.models, self.dfs)]
+        return np.mean(np.array(preds), axis = 0)
+
+    def predict_prob(self, X):
+        return self.predict_proba(X)[:,1]
+
+    def predict(self, X):
+        return np.round(self.predict_prob(X))
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LogisticRegression
+from credit_models import create_pipeline
+
+# candidate features screened at a time
+BLOCK = 4096
+
+# factor of the C of the pruning fits, looser than the final fit so that pruning keeps its features
+PRUNE_C = 10
+
+
+def column_blocks(features, size=BLOCK):
+    """
+    Yields the columns and values of a feature matrix in blocks of at
+    most size columns. A lazy FeatureMatrix of feature_synthesis.py is
+    materialized one block at a time, a DataFrame is sliced.
+    """
+    if hasattr(features, 'blocks'):
+        for frame in features.blocks(size):
+            yield frame.columns, frame.values
+    else:
+        for start in range(0, features.shape[1], size):
+            frame = features.iloc[:, start:start + size]
+            yield frame.columns, np.asarray(frame, dtype=float)
+
+
+def screen_blocks(features, size=BLOCK):
+    """
+    Yields the names and values of each block of features, without
+    the features with missing values or zero variance.
+    """
+    for columns, values in column_blocks(features, size):
+        with np.errstate(invalid='ignore'):
+            var = np.var(values, axis=0, ddof=1)
+        #infinite values give a NaN variance, as in pandas
+        keep = ~np.isnan(values).any(axis=0) & (var > 0)
+        yield list(columns[keep]), values[:, keep]
+
+
+def lasso_mask(X_m, y, reg_params):
+    """
+    Fits a logistic regression with L1 regularization and returns the
+    mask of the features with non-zero coefficients.
+    """
+    #mask for the dummy variables
+    dummy = [i for i, x in enumerate((X_m.max() != 1)|(X_m.min() != 0)) if x]
+    #create and fit log regression
+    test_model = create_pipeline(LogisticRegression(**reg_params, solver='liblinear'), dummy)
+    test_model.fit(X_m, y)
+    return test_model.coef_[0] != 0
+
+
+def select_features(features, y, x_ind, x_t_ind, reg_params, size=BLOCK):
+    """
+    Takes in a feature matrix, the target of the train data and the
+    indices of train and test data. Returns a feature matrix of the
+    features selected by a logistic regression with L1 regularization,
+    with train and test data stacked.
+
+    The features are screened a block of size columns at a time:
+    features with missing values or zero variance are dropped and the
+    survivors pooled. When the pool grows beyond size columns, it is
+    pruned to the features with non-zero coefficients of a fit on the
+    pool, and a last fit on the pool selects the features returned.
+    Only the pool and one block are held in memory. With all features
+    in one block this is the single fit of the full feature matrix.
+    The pruning fits are PRUNE_C times less regularized than the last
+    fit, but an L1 fit on a subset of the features does not always keep
+    the features of a fit on all of them: with more than size features
+    the selection can still depend on size and on the column order.
+
+    features = DataFrame or lazy FeatureMatrix indexed by loan
+    """
+    index = pd.Index(features.index)
+    train, test = index.get_indexer(x_ind), index.get_indexer(x_t_ind)
+    if (train < 0).any() or (test < 0).any():
+        missing = list(pd.Index(x_ind)[train < 0]) + list(pd.Index(x_t_ind)[test < 0])
+        raise KeyError('Loans not in the feature matrix: {}'.format(missing[:10]))
+
+    names, pool = [], np.empty((len(index), 0))
+    for columns, values in screen_blocks(features, size):
+        names += columns
+        pool = np.hstack([pool, values])
+        if len(names) > size:
+            prune_params = dict(reg_params, C=reg_params.get('C', 1.0) * PRUNE_C)
+            keep = lasso_mask(pd.DataFrame(pool[train], columns=names), y, prune_params)
+            names, pool = list(np.array(names, dtype=object)[keep]), pool[:, keep]
+
+    X_m = pd.DataFrame(pool[train], index=index[train], columns=names)
+    X_m_test = pd.DataFrame(pool[test], index=index[test], columns=names)
+    keep = lasso_mask(X_m, y, reg_params)
+    return pd.concat([X_m.loc[:, keep], X_m_test.loc[:, keep]])
@@ -0,0 +1,205 @@
+import numpy as np
+import pandas as pd
+from berka_cache import read_chunks, read_table
+from pipeline import WINDOWS, SUFFIXES
+from trans_agg import AGG_COLUMNS
+from trans_stream import prep_trans, CHUNKSIZE
+
+# transaction variables kept as prefix sums, the rates without missing and infinite values
+SUM_COLUMNS = ['balance', 'c_deposit', 'c_withdr', 'sanc', 'net_cdeposit', 'net_bdeposit', 'day',
+               'rate', 'rate_count', 'rate_inf']
+
+
+def range_table(values, depth, op):
+    """
+    Returns the levels of a sparse table of values: level k holds op
+    over the 2**k rows from each row, so that op over any range of at
+    most 2**(depth + 1) - 1 rows is computed from two entries.
+    """
+    levels = [values]
+    for k in range(1, depth + 1):
+        half = 1 << (k - 1)
+        levels.append(op(levels[-1][:-half], levels[-1][half:]))
+    return levels
+
+
+def range_query(levels, a, b, op):
+    #op over the rows a..b-1 as op of two overlapping power of two ranges
+    k = int(b - a).bit_length() - 1
+    return op(levels[k][a], levels[k][b - (1 << k)])
+
+
+class FeatureStore:
+    """
+    Point-in-time store of the transaction aggregates. The transactions
+    are kept sorted by account and date, with prefix sums of the summed
+    variables per account and sparse tables of the minima and maxima,
+    so that the aggregates of a single account at any date are computed
+    with a few binary searches and lookups, whatever the window. The
+    sparse tables hold log2 of the most transactions of an account
+    copies of each variable.
+
+    trans = prepped transactions with account_id and date columns
+    clients = number of clients per account_id. The batch pipeline
+            merges the transactions once per client of the loan account,
+            which multiplies the sums and counts of the aggregates.
+    """
+    def __init__(self, trans, clients=None):
+        trans = trans.reset_index(drop=True)
+        trans['pos'] = np.arange(len(trans))
+        trans = trans.sort_values(['account_id', 'date', 'pos'], kind='mergesort')
+
+        self.day = ((trans.date.values - np.datetime64('1970-01-01')) // np.timedelta64(1, 'D')).astype(np.int64)
+        self.pos = trans.pos.values
+        amount = trans.amount_trans.values.astype(float)
+        c_deposit = trans.c_deposit.values.astype(float)
+        c_withdr = trans.c_withdr.values.astype(float)
+        b_deposit = trans.b_deposit.values.astype(float)
+        b_withdr = trans.b_withdr.values.astype(float)
+
+        self.balance = trans.balance.values.astype(float)
+        self.balance_start = self.balance - amount
+        self.rate = (amount * trans.interest.values) / (self.balance - amount)
+        self.net_bdeposit = (b_deposit - b_withdr) * amount
+        finite = np.isfinite(self.rate)
+        values = {'balance': self.balance, 'c_deposit': c_deposit, 'c_withdr': c_withdr,
+                  'sanc': trans.sanc.values.astype(float), 'net_cdeposit': (c_deposit - c_withdr) * amount,
+                  'net_bdeposit': self.net_bdeposit, 'day': self.day.astype(float),
+                  'rate': np.where(finite, self.rate, 0), 'rate_count': (~np.isnan(self.rate)).astype(float),
+                  'rate_inf': np.isinf(self.rate).astype(float)}
+
+        #prefix sums from the first transaction of each account, so that the
+        #window sums do not carry the rounding of the sums of other accounts
+        accounts = trans.account_id.values
+        self.sums = pd.DataFrame(values)[SUM_COLUMNS].groupby(accounts, sort=False).cumsum().values
+
+        #the windows are within an account, so the tables span all accounts
+        sizes = np.diff(np.flatnonzero(np.r_[True, accounts[1:] != accounts[:-1], True])) if len(accounts) else [1]
+        depth = int(np.max(sizes)).bit_length() - 1
+        self.balance_min = range_table(self.balance, depth, np.minimum)
+        self.balance_max = range_table(self.balance, depth, np.maximum)
+        self.net_bdeposit_max = range_table(self.net_bdeposit, depth, np.maximum)
+        #missing rates are ignored, as in the batch aggregation
+        self.rate_min = range_table(self.rate, depth, np.fmin)
+        self.rate_max = range_table(self.rate, depth, np.fmax)
+        #the first transaction of a window in file order
+        self.first_pos = range_table(self.pos, depth, np.minimum)
+        self.balance_start_by_pos = np.empty(len(self.pos))
+        self.balance_start_by_pos[self.pos] = self.balance_start
+
+        starts = np.flatnonzero(np.r_[True, accounts[1:] != accounts[:-1]]) if len(accounts) else []
+        ends = np.r_[starts[1:], len(accounts)] if len(accounts) else []
+        self.index = {account: (start, end) for account, start, end
+                      in zip(accounts[starts], starts, ends)}
+        self.clients = {} if clients is None else clients.to_dict()
+
+    def get_features(self, account_id, as_of_date, windows=WINDOWS, suffixes=SUFFIXES):
+        """
+        Returns the transaction aggregates of the account as of the given
+        date, using only transactions before it. The keys and values are
+        those of the batch loan data for a loan issued on as_of_date.
+        """
+        start, end = self.index.get(account_id, (0, 0))
+        day = (np.datetime64(pd.Timestamp(as_of_date), 'D') - np.datetime64('1970-01-01', 'D')).astype(np.int64)
+        days = self.day[start:end]
+        weight = self.clients.get(account_id, 1)
+
+        features = {}
+        for i, (time_window_max, time_window_min) in enumerate(windows):
+            #rows with time_window_min < day - date < time_window_max
+            a = start + np.searchsorted(days, day - time_window_max, 'right')
+            b = start + np.searchsorted(days, min(day - time_window_min, day), 'left')
+            block = self._window(start, a, b, day, weight)
+            if block is None:
+                if i == 0:
+                    return {col + suffixes[j]: np.nan for j in range(len(windows)) for col in AGG_COLUMNS}
+                block = dict.fromkeys(AGG_COLUMNS, np.nan)
+            elif i > 0:
+                block = {col: float(value) for col, value in block.items()}
+            for col in AGG_COLUMNS:
+                features[col + suffixes[i]] = block[col]
+        return features
+
+    def _window(self, start, a, b, day, weight):
+        n = b - a
+        if n <= 0:
+            return None
+        #sums of the rows start..b-1 less those of the rows start..a-1 of the account
+        sums = dict(zip(SUM_COLUMNS, self.sums[b - 1] - self.sums[a - 1] if a > start else self.sums[b - 1]))
+        first = self.balance_start_by_pos[range_query(self.first_pos, a, b, np.minimum)]
+        balance_min = min(range_query(self.balance_min, a, b, np.minimum), first)
+        balance_max = range_query(self.balance_max, a, b, np.maximum)
+        net_bdeposit_max = range_query(self.net_bdeposit_max, a, b, np.maximum)
+
+        count = int(round(sums['rate_count']))
+        if sums['rate_inf'] > 0:
+            #infinite rates have no prefix sum
+            rate = self.rate[a:b]
+            rate_mean = rate[~np.isnan(rate)].mean()
+        else:
+            rate_mean = sums['rate'] / count if count else np.nan
+        if count:
+            rate_min = range_query(self.rate_min, a, b, np.fmin)
+            rate_max = range_query(self.rate_max, a, b, np.fmax)
+        else:
+            rate_min = rate_max = np.nan
+
+        block = {
+            'balance_min': balance_min,
+            'balance_mean': sums['balance'] / n,
+            'balance_max': max(balance_max, first),
+            'c_deposit_sum': int(round(sums['c_deposit'])) * weight,
+            'c_withdr_sum': int(round(sums['c_withdr'])) * weight,
+            'sanc_max': int(sums['sanc'] > 0),
+            'rate_min': rate_min,
+            'rate_mean': rate_mean,
+            'rate_max': rate_max,
+            'transactions_sum': n * weight,
+            'net_cdeposit_sum': sums['net_cdeposit'] * weight,
+            'net_bdeposit_sum': sums['net_bdeposit'] * weight,
+            'net_bdeposit_max': net_bdeposit_max,
+            'age_mean': (n * day - sums['day']) / n,
+            'neg_bal': int(balance_min < 0)
+        }
+        return block
+
+
+def load_store(chunksize=CHUNKSIZE):
+    """
+    Builds the feature store from the parsed Berka transactions,
+    with the client counts of the accounts from the disp table.
+    """
+    chunks = [prep_trans(trans, ['account_id', 'date'])
+              for trans in read_chunks('trans', chunksize,
+                                       ['account_id', 'date', 'operation', 'amount', 'balance', 'k_symbol'])]
+    clients = read_table('disp', ['account_id']).groupby('account_id').size()
+    return FeatureStore(pd.concat(chunks, ignore_index=True), clients)
+
+
+def check_store(store, loan_data, dates, windows=WINDOWS, suffixes=SUFFIXES):
+    """
+    Compares the features of the store for every loan with the batch
+    loan data. Returns the largest relative difference by column, a
+    value missing on one side only counts as infinite.
+
+    loan_data = batch loan data indexed by loan_id, as of build_loan_data
+    dates = loan_id, account_id and date_loan of the loans, as of loan_dates
+    """
+    dates = dates.drop_duplicates('loan_id').set_index('loan_id').loc[loan_data.index]
+    features = pd.DataFrame([store.get_features(account, date, windows, suffixes)
+                             for account, date in zip(dates.account_id, dates.date_loan)], index=dates.index)
+    batch = loan_data[features.columns].astype(float)
+    features = features.astype(float)
+    missing = batch.isna() != features.isna()
+    diff = ((features - batch).abs() / batch.abs().clip(lower=1)).fillna(0)
+    return diff.mask(missing, np.inf).max()
+
+
+if __name__ == "__main__":
+    #parity of the store with the batch loan data for every loan, exits with an error on a mismatch
+    import sys
+    from pipeline import build_loan_data, loan_dates
+    diff = check_store(load_store(), build_loan_data(), loan_dates())
+    print(diff.to_string())
+    if (diff > 1e-12).any():
+        sys.exit('features of the store differ from the batch loan data')
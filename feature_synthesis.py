@@ -0,0 +1,215 @@
+import numpy as np
+import pandas as pd
+
+# aggregation primitives of the transactions to loan-level
+AGG_PRIMITIVES = ['min', 'mean', 'max', 'last']
+
+# numeric transform primitives as (symbol, function, commutative)
+TRANS_PRIMITIVES = {
+    'multiply_numeric': ('*', np.multiply, True),
+    'add_numeric': ('+', np.add, True),
+    'divide_numeric': ('/', np.divide, False)
+}
+
+# columns of transform features computed at a time
+BLOCK = 64
+
+
+def pairs(names, commutative):
+    """
+    Returns the index pairs and names of a pairwise transform of the
+    features in names, as deep feature synthesis generates them: each
+    unordered pair once, with the names sorted ignoring case, for
+    commutative transforms and each ordered pair for the others.
+    """
+    left, right = [], []
+    for i in range(len(names)):
+        for j in range(len(names)):
+            if i == j or (commutative and j < i):
+                continue
+            if commutative and names[j].lower() < names[i].lower():
+                left.append(j)
+                right.append(i)
+            else:
+                left.append(i)
+                right.append(j)
+    return np.array(left, dtype=np.intp), np.array(right, dtype=np.intp)
+
+
+def pair_names(names, left, right, symbol):
+    return ['{} {} {}'.format(names[i], symbol, names[j]) for i, j in zip(left, right)]
+
+
+class GroupedTrans:
+    """
+    Transactions sorted once by loan, with the group boundaries of
+    the loans in index, so that the aggregation primitives reduce
+    a block of columns at a time with ufunc.reduceat.
+    """
+    def __init__(self, trans, index, key='loan_id'):
+        codes = pd.Index(index).get_indexer(trans[key])
+        keep = codes >= 0
+        order = np.argsort(codes[keep], kind='stable')
+        self.rows = np.flatnonzero(keep)[order]
+        codes = codes[keep][order]
+
+        self.has_rows = np.zeros(len(index), dtype=bool)
+        self.has_rows[codes] = True
+        self.starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.array([], int)
+        self.ends = np.r_[self.starts[1:], len(codes)].astype(np.intp)
+        self.n = len(index)
+
+    def aggregate(self, values, primitive):
+        """
+        Aggregates the sorted rows of a (rows x columns) array to a
+        (loans x columns) array, NaN for loans without transactions.
+        min, max and mean skip missing values, last is the last row.
+        """
+        out = np.full((self.n, values.shape[1]), np.nan)
+        if len(self.starts) == 0:
+            return out
+        if primitive == 'min':
+            result = np.fmin.reduceat(values, self.starts, axis=0)
+        elif primitive == 'max':
+            result = np.fmax.reduceat(values, self.starts, axis=0)
+        elif primitive == 'mean':
+            missing = np.isnan(values)
+            sums = np.add.reduceat(np.where(missing, 0, values), self.starts, axis=0)
+            counts = np.add.reduceat(~missing, self.starts, axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result = np.where(counts > 0, sums / counts, np.nan)
+            infinite = np.isinf(values)
+            if infinite.any():
+                #the compensated sum of pandas is NaN after an infinite value, so the
+                #mean is infinite only if the single infinite value is the last one
+                position = np.arange(len(values))[:, None]
+                last = np.maximum.reduceat(np.where(missing, -1, position), self.starts, axis=0)
+                last_inf = np.maximum.reduceat(np.where(infinite, position, -1), self.starts, axis=0)
+                n_inf = np.add.reduceat(infinite, self.starts, axis=0)
+                result[(n_inf > 1) | ((n_inf == 1) & (last_inf != last))] = np.nan
+        elif primitive == 'last':
+            result = values[self.ends - 1]
+        else:
+            raise ValueError('Unknown aggregation primitive {}'.format(primitive))
+        out[self.has_rows] = result
+        return out
+
+
+class FeatureMatrix:
+    """
+    Feature matrix of deep feature synthesis with the loan-level
+    transform features left unmaterialized. The base features, the
+    loan variables and the aggregated transaction features, are kept
+    in one array and the transform features are computed from it on
+    demand, a block of columns at a time.
+    """
+    def __init__(self, index, base, base_names, numeric, function, symbol, commutative):
+        self.index = index
+        self.base = base
+        self.function = function
+        left, right = pairs([base_names[i] for i in numeric], commutative)
+        numeric = np.asarray(numeric, dtype=np.intp)
+        #column k is base feature k, or the transform of base features left[k] and right[k]
+        self.left = np.r_[np.arange(len(base_names)), numeric[left]]
+        self.right = np.r_[np.full(len(base_names), -1), numeric[right]]
+        self.columns = pd.Index(base_names + pair_names(base_names, numeric[left], numeric[right], symbol))
+
+    @property
+    def shape(self):
+        return len(self.index), len(self.columns)
+
+    def values(self, positions):
+        """
+        Returns the (loans x len(positions)) array of the features at
+        the given column positions.
+        """
+        positions = np.asarray(positions, dtype=np.intp)
+        out = np.empty((len(self.index), len(positions)))
+        left, right = self.left[positions], self.right[positions]
+        base = right < 0
+        out[:, base] = self.base[:, left[base]]
+        pair = np.flatnonzero(~base)
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            for start in range(0, len(pair), BLOCK):
+                block = pair[start:start + BLOCK]
+                out[:, block] = self.function(self.base[:, left[block]], self.base[:, right[block]])
+        return out
+
+    def blocks(self, size=1024):
+        """
+        Yields the feature matrix as DataFrames of at most size columns.
+        """
+        for start in range(0, len(self.columns), size):
+            positions = np.arange(start, min(start + size, len(self.columns)))
+            yield pd.DataFrame(self.values(positions), index=self.index, columns=self.columns[positions])
+
+    def to_frame(self, columns=None):
+        """
+        Materializes the given columns, or all of them, as a DataFrame.
+        """
+        positions = np.arange(len(self.columns)) if columns is None else self.columns.get_indexer(columns)
+        if (positions < 0).any():
+            raise KeyError('Unknown features {}'.format(list(pd.Index(columns)[positions < 0])))
+        return pd.DataFrame(self.values(positions), index=self.index, columns=self.columns[positions])
+
+
+def synthesize(loans, trans, agg_primitives=AGG_PRIMITIVES, trans_primitive='multiply_numeric',
+               key='loan_id'):
+    """
+    Deep feature synthesis of depth 2 from the dfs_prep.py outputs, the
+    equivalent of featuretools dfs with the loans as the target entity,
+    the transactions as its child and one transform primitive. The
+    features and their names are those of featuretools:
+
+    amount                              loan variable
+    MEAN(trans.balance)                 aggregated transaction variable
+    MEAN(trans.amount_trans * balance)  aggregated transaction transform
+    amount * MEAN(trans.balance)        transform of the above two kinds
+    LAST(trans.id)                      position of the last transaction
+
+    loans = static loan data with the key column, without the target
+    trans = transactions with the key column, the index is the id
+    """
+    if trans_primitive not in TRANS_PRIMITIVES:
+        raise ValueError('Unknown transform primitive {}'.format(trans_primitive))
+    symbol, function, commutative = TRANS_PRIMITIVES[trans_primitive]
+
+    loans = loans.set_index(key) if key in loans else loans
+    loan_cols = list(loans.select_dtypes('number').columns)
+    trans_cols = [col for col in trans.select_dtypes('number').columns if col != key]
+    grouped = GroupedTrans(trans, loans.index, key)
+
+    #transaction variables sorted by loan, and their pairwise transforms
+    values = trans[trans_cols].values.astype(float)[grouped.rows]
+    t_left, t_right = pairs(trans_cols, commutative)
+    t_names = trans_cols + pair_names(trans_cols, t_left, t_right, symbol)
+
+    def trans_blocks():
+        yield trans_cols, values
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            for start in range(0, len(t_left), BLOCK):
+                left, right = t_left[start:start + BLOCK], t_right[start:start + BLOCK]
+                yield t_names[len(trans_cols) + start:len(trans_cols) + start + len(left)], \
+                    function(values[:, left], values[:, right])
+
+    aggs = {primitive: [] for primitive in agg_primitives}
+    for names, block in trans_blocks():
+        for primitive in agg_primitives:
+            aggs[primitive].append(grouped.aggregate(block, primitive))
+
+    #loan variables, then the aggregated transaction variables and last their transforms
+    base = [loans[loan_cols].values.astype(float)]
+    base_names = list(loan_cols)
+    for primitive in agg_primitives:
+        base.append(aggs[primitive][0])
+        base_names += ['{}(trans.{})'.format(primitive.upper(), col) for col in trans_cols]
+    numeric = list(range(len(base_names)))
+    if 'last' in agg_primitives:
+        ids = trans.index.values.astype(float)[grouped.rows][:, None]
+        base.append(grouped.aggregate(ids, 'last'))
+        base_names.append('LAST(trans.id)')
+    for primitive in agg_primitives:
+        base += aggs[primitive][1:]
+        base_names += ['{}(trans.{})'.format(primitive.upper(), name) for name in t_names[len(trans_cols):]]
+
+    return FeatureMatrix(loans.index, np.hstack(base), base_names, numeric, function, symbol, commutative)
@@ -0,0 +1,32 @@
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.utils import _safe_indexing
+
+# data shared with the worker processes of the model fits, set once per process
+X, y = None, None
+
+
+def set_data(X_data, y_data):
+    global X, y
+    X, y = X_data, y_data
+
+
+def rows(indices):
+    """
+    Returns the rows of the shared data at indices, as X and y.
+    """
+    return _safe_indexing(X, indices), _safe_indexing(y, indices)
+
+
+def data_pool(X_data, y_data, n_jobs):
+    """
+    Shares X_data and y_data with this process and returns a pool of
+    n_jobs worker processes that hold them, so that the data is sent
+    to each worker once instead of with every fit. Returns None when
+    n_jobs is None or 1, for the fits to run in this process. A
+    negative n_jobs uses all cores.
+    """
+    set_data(X_data, y_data)
+    if n_jobs is None or n_jobs == 1:
+        return None
+    return ProcessPoolExecutor(None if n_jobs < 0 else n_jobs, initializer=set_data,
+                               initargs=(X_data, y_data))
@@ -0,0 +1,221 @@
+# # STAGE INSTRUMENTATION
+# Records the wall time, CPU time, peak resident memory and row counts of named stages of the pipeline.
+# Off by default, when off a stage costs a function call. Switched on with the BERKA_PROFILE environment
+# variable, set to 1 or to the path of the JSON report, or with the --profile flag of the scripts.
+# BERKA_PROFILE_STAGE names a stage to capture with cProfile, or with tracemalloc if BERKA_PROFILE_MODE
+# is tracemalloc.
+#
+#   BERKA_PROFILE=report.json BERKA_PROFILE_STAGE=aggregate python credit_risk_datagen.py
+#
+# Stages nest, a stage run inside another is reported as 'outer/inner'. A stage run several times,
+# e.g. once per transaction chunk, is reported once with the totals over all calls.
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import platform
+from contextlib import contextmanager
+
+REPORT_PATH = 'profile_report.json'
+
+_enabled = False
+_report_path = None
+_profile_stage = None
+_profile_mode = 'cprofile'
+_records = {}
+_stack = []
+_captures = {}
+
+
+def rss_kb(field):
+    """
+    Returns a memory field of /proc/self/status in kB, e.g. VmHWM, the
+    peak resident memory. Without /proc the peak since the start of
+    the process is returned.
+    """
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak():
+    #linux resets the peak resident memory when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+class StageTimer:
+    """
+    Measurement of one run of a stage. Set rows to record the number
+    of rows the stage produced.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.child_peak = 0
+
+
+class _NullStage:
+    rows = None
+
+
+_null = _NullStage()
+
+
+def enable(report_path=None, profile_stage=None, profile_mode=None):
+    """
+    Switches the instrumentation on. The report is written to
+    report_path when the process exits.
+    """
+    global _enabled, _report_path, _profile_stage, _profile_mode
+    if not _enabled:
+        atexit.register(write_report)
+    _enabled = True
+    _report_path = report_path or _report_path or REPORT_PATH
+    _profile_stage = profile_stage or _profile_stage
+    _profile_mode = profile_mode or _profile_mode
+
+
+def enabled():
+    return _enabled
+
+
+@contextmanager
+def stage(name):
+    """
+    Measures the code in the with block as the stage name:
+
+        with stage('merge account') as s:
+            df = pd.merge(...)
+            s.rows = len(df)
+    """
+    if not _enabled:
+        yield _null
+        return
+
+    timer = StageTimer(name)
+    path = '/'.join([parent.name for parent in _stack] + [name])
+    if _stack:
+        #keep the peak of the parent before it is reset for this stage
+        _stack[-1].child_peak = max(_stack[-1].child_peak, rss_kb('VmHWM'))
+    _stack.append(timer)
+    capture = _start_capture(name, path)
+    reset_peak()
+    start_rss = rss_kb('VmRSS')
+    start, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield timer
+    finally:
+        seconds, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+        peak = max(rss_kb('VmHWM'), timer.child_peak)
+        _stack.pop()
+        if _stack:
+            _stack[-1].child_peak = max(_stack[-1].child_peak, peak)
+        if capture is not None:
+            _stop_capture(capture, path)
+
+        record = _records.setdefault(path, {'stage': path, 'calls': 0, 'seconds': 0.0, 'cpu_seconds': 0.0,
+                                            'peak_rss_mb': 0.0, 'rss_delta_mb': 0.0, 'rows': None})
+        record['calls'] += 1
+        record['seconds'] += seconds
+        record['cpu_seconds'] += cpu
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], peak / 1024)
+        record['rss_delta_mb'] += (rss_kb('VmRSS') - start_rss) / 1024
+        if timer.rows is not None:
+            record['rows'] = (record['rows'] or 0) + int(timer.rows)
+
+
+def _start_capture(name, path):
+    if _profile_stage not in (name, path):
+        return None
+    if _profile_mode == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start(25)
+        return tracemalloc
+    import cProfile
+    #one profiler per stage, accumulated over the calls
+    profiler = _captures.setdefault(path, cProfile.Profile())
+    profiler.enable()
+    return profiler
+
+
+def _stop_capture(capture, path):
+    if capture is not sys.modules.get('tracemalloc'):
+        capture.disable()
+        return
+    peak = capture.get_traced_memory()[1]
+    snapshot = capture.take_snapshot()
+    capture.stop()
+    #keep the allocations of the call with the highest peak
+    if peak >= _captures.get(path, {}).get('peak_traced_mb', 0) * 2 ** 20:
+        _captures[path] = {'peak_traced_mb': peak / 2 ** 20, 'top': [
+            {'line': str(stat.traceback[0]), 'size_mb': stat.size / 2 ** 20, 'count': stat.count}
+            for stat in snapshot.statistics('lineno')[:25]]}
+
+
+def _capture_report(path, capture):
+    if isinstance(capture, dict):
+        return capture
+    import io
+    import pstats
+    prof_path = os.path.splitext(_report_path)[0] + '.' + path.replace('/', '.').replace(' ', '_') + '.prof'
+    capture.dump_stats(prof_path)
+    text = io.StringIO()
+    pstats.Stats(capture, stream=text).sort_stats('cumulative').print_stats(25)
+    return {'prof_file': prof_path, 'top': text.getvalue()}
+
+
+def report():
+    """
+    Returns the report of the stages run so far, in the order they
+    were first started.
+    """
+    return {
+        'argv': sys.argv,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': sys.modules['pandas'].__version__ if 'pandas' in sys.modules else None,
+        'profile_stage': _profile_stage,
+        'profile_mode': _profile_mode if _profile_stage else None,
+        'stages': list(_records.values()),
+        'captures': {path: _capture_report(path, capture) for path, capture in _captures.items()}
+    }
+
+
+def write_report(path=None):
+    path = path or _report_path
+    if not _enabled or not _records:
+        return
+    with open(path, 'w') as file:
+        json.dump(report(), file, indent=2)
+
+
+def from_args(argv):
+    """
+    Enables the instrumentation if --profile or --profile=path is in
+    argv and returns argv without it.
+    """
+    rest = []
+    for arg in argv:
+        if arg == '--profile':
+            enable()
+        elif arg.startswith('--profile='):
+            enable(arg.split('=', 1)[1])
+        else:
+            rest.append(arg)
+    return rest
+
+
+if os.environ.get('BERKA_PROFILE'):
+    enable(None if os.environ['BERKA_PROFILE'] == '1' else os.environ['BERKA_PROFILE'],
+           os.environ.get('BERKA_PROFILE_STAGE'), os.environ.get('BERKA_PROFILE_MODE'))
@@ -0,0 +1,66 @@
+# # LOAD TEST FOR THE SCORING SERVICE
+# Sends single-row score requests from concurrent clients and reports the throughput,
+# the client-side latencies and the metrics of the service.
+#
+#   python load_test.py bk/artifacts/loan_data --clients 32 --requests 200
+#
+# The rows sent are the columns of the data named by the features of the served model, when it has them.
+import os
+import argparse
+import pickle
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scoring_client import ScoringClient
+
+
+def run_client(rows, n_requests, host, port, seed):
+    rng = np.random.default_rng(seed)
+    client = ScoringClient(host, port)
+    latencies = []
+    for i in rng.integers(0, len(rows), n_requests):
+        start = time.perf_counter()
+        client.score([rows[i]])
+        latencies.append(time.perf_counter() - start)
+    client.close()
+    return latencies
+
+
+def load_test(rows, clients=16, requests=100, host='127.0.0.1', port=8080):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        results = pool.map(lambda seed: run_client(rows, requests, host, port, seed), range(clients))
+        latencies = np.concatenate(list(results)) * 1000
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': np.percentile(latencies, 50),
+        'p99_ms': np.percentile(latencies, 99)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test the scoring service.')
+    parser.add_argument('data', help='table artifact or pickled DataFrame of feature rows, e.g. bk/artifacts/loan_data')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=100, help='requests per client')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.data):
+        import artifacts
+        data = artifacts.read_table(args.data)
+    else:
+        with open(args.data, 'rb') as file:
+            data = pickle.load(file, encoding="latin1")
+    columns = ScoringClient(args.host, args.port).health()['columns']
+    if columns is not None and set(columns) <= set(data.columns):
+        data = data[columns]
+    rows = np.asarray(data, dtype=float).tolist()
+
+    result = load_test(rows, args.clients, args.requests, args.host, args.port)
+    print('{requests} requests, {throughput:.0f} requests/s, p50 {p50_ms:.2f} ms, p99 {p99_ms:.2f} ms'
+          .format(**result))
+    print('Service metrics:', ScoringClient(args.host, args.port).metrics())
@@ -0,0 +1,335 @@
+# # DATA MERGING AND FEATURE GENERATION FOR CREDIT RISK ANALYSIS
+# The pipeline is split into stages: load tables -> static join -> loan features -> transaction pass.
+# Each stage is computed lazily on first use and memoized, so that importing the module does no work
+# and the outputs of credit_risk_datagen.py and dfs_prep.py can be built from one run.
+import pandas as pd
+pd.options.mode.chained_assignment = None
+import pickle
+import numpy as np
+import os
+import sys
+from functools import lru_cache
+import artifacts
+from berka_cache import read_table
+from trans_stream import read_trans_loans, partitioned_pass, StreamAggregator
+import instrument
+from instrument import stage
+
+TABLES = ['client', 'account', 'disp', 'order', 'loan', 'card', 'district']
+
+# full history up until the most recent two months and the recent two months separately
+WINDOWS = ((3000, 60), (60, 0))
+SUFFIXES = ('', '_short')
+
+# aggregator state kept between incremental runs
+STATE_PATH = 'loan_state'
+
+# worker processes of the transaction pass, set with --workers=N
+WORKERS = 1
+
+
+@lru_cache(maxsize=None)
+def load_tables():
+    tables = {}
+    with stage('ingest'):
+        for name in TABLES:
+            with stage('read ' + name) as s:
+                tables[name] = read_table(name)
+                s.rows = len(tables[name])
+    return tables
+
+
+# ### Reading and merging the loan and account -related datasets
+# We merge the static datasets and explore proportional missingness in the full data.
+# The tables are read from a typed columnar cache of the .asc files, so the dates are already parsed.
+
+@lru_cache(maxsize=None)
+def static_join():
+    tables = load_tables()
+    with stage('static merge'):
+        with stage('merge account') as s:
+            df = pd.merge(tables['loan'], tables['account'], on='account_id', suffixes=['_loan','_acnt'], how='outer')
+            s.rows = len(df)
+        with stage('merge disp') as s:
+            df = pd.merge(df, tables['disp'], on='account_id', how='outer')
+            s.rows = len(df)
+        with stage('merge client') as s:
+            df = pd.merge(df, tables['client'], on='client_id', how='outer', suffixes = ['_clnt','_acnt'])
+            s.rows = len(df)
+        with stage('merge district') as s:
+            df = pd.merge(df, tables['district'], left_on='district_id_clnt', right_on='A1', how='outer')
+            s.rows = len(df)
+        with stage('merge card') as s:
+            df = pd.merge(df, tables['card'], on='disp_id', how='outer', suffixes=['', '_card'])
+            s.rows = len(df)
+    return df
+
+
+@lru_cache(maxsize=None)
+def loan_dates():
+    """
+    Table of account, loan and loan date used for merging the
+    transactions, with one row per client of the loan account.
+    """
+    df = static_join()
+    return df.loc[~df.loan_id.isna(), ['account_id','loan_id','date_loan']]
+
+
+# ### Feature generation for loans
+#
+# We first drop observations on users that do not have a loan associated in any of the accounts they participate in.
+#
+# We also drop some irrelevant columns. Most of the identification was only necessary for joining the data, so they are dropped.
+# There are only 5 junior and 3 gold cards in the data so the card type is dropped as well.
+#
+# We then encode features into formats suitable for machine learning.
+#
+# The demographic data is available only as static values measured after some of the loans in the data are already issued.
+# Because ex-ante values are not available, we make the assumption that  the demographics do not drastically change across years.
+# However, if the demographics turn out to be important in predicting credit defaults, this problem should be readdressed.
+
+@lru_cache(maxsize=None)
+def loan_features():
+    df = static_join()
+    loans = df[~df.loan_id.isna()]
+
+    #drop unnecessary columns
+    loans = loans.drop(['account_id','district_id_acnt','district_id_clnt', 'disp_id',
+                        'client_id', 'card_id', 'type_card'], axis=1)
+
+    #create dummy for whether the loan completed successfully
+    loans['target'] = (loans.status == 'B').astype(int) + (loans.status == 'D').astype(int)
+
+    #find gender (encoded into the birthnumber) and convert birthdate into datetime
+    loans['gender'] = (loans.birth_number % 10000 > 5000).astype(int)
+    loans['birthdate'] = loans.birth_number - 5000 * loans.gender + 19000000
+    loans['birthdate'] = pd.to_datetime(loans.birthdate, format='%Y%m%d')
+
+    #find the age of applicant and the account at the time of loan issuance
+    loans['appl_age'] = (loans.date_loan - loans.birthdate).dt.days / 365.25
+    loans['accnt_age'] = (loans.date_loan - loans.date_acnt).dt.days / 365.25
+
+    #create dummy for whether the account has an associated card at the time of loan issuance
+    loans['issued'] = (loans.issued < loans.date_loan).astype(int)
+
+    #create dummies for the frequency of statement issuance and the account type
+    with stage('get_dummies'):
+        loans = pd.get_dummies(loans, columns=['frequency', 'type'], drop_first=True)
+
+    # select unemployment and crime from the demographic statistics.
+    loans['A13'] = np.select([loans.date_loan.dt.year > 1996,
+                                 loans.date_loan.dt.year < 1997],
+                                [loans.A13, loans.A12])
+
+    loans['A12'] = np.select([loans.date_loan.dt.year > 1996, loans.date_loan.dt.year < 1997],
+              [loans.A16, loans.A15])
+
+    # convert the columns to numeric values and scale the crime numbers for population
+    loans['A13'] = pd.to_numeric(loans.A13, errors='coerce')
+    loans['A12'] = pd.to_numeric(loans.A12, errors='coerce') / loans.A4
+    loans['A14'] = loans.A14 / loans.A4 * 100
+
+    #finally, aggregate to loan-level from client-level data
+    with stage('groupby mean') as s:
+        loans = loans.groupby('loan_id').agg('mean')
+        s.rows = len(loans)
+    #create dummy for loans, where the account has multiple users
+    loans['multi'] = np.select([loans.type_OWNER < 1], [1], 0)
+
+    #drop unnecessary columns
+    loans.drop(['birth_number','type_OWNER','A16'], axis=1, inplace=True)
+
+    #rename columns
+    loans.columns = ['amount', 'duration', 'payments', 'A1', 'A4', 'A5', 'A6', 'A7', 'A8',
+           'A9', 'A10', 'A11', 'A12', 'A13', 'A14', 'issued', 'target', 'gender',
+           'appl_age', 'accnt_age', 'frequency_trans',
+           'frequency_weekly', 'multi']
+
+    #address missing employment and crime values
+    loans.loc[loans.A13.isna(),['A12','A13']] = loans.loc[5281,['A12','A13']].values
+    loans.drop('A1', axis=1, inplace=True)
+    return loans
+
+
+# ### Read in and merge transaction data
+# The transaction file is read in chunks. Each chunk is merged with the loan dates, filtered to transactions
+# prior to loan issuance and aggregated to loan-level, so only the per-loan statistics are kept in memory.
+
+@lru_cache(maxsize=None)
+def trans_pass(windows=WINDOWS, keep=False):
+    """
+    Runs one pass over the transactions. Returns the stream
+    aggregator over the given windows and, if keep is True,
+    the prepped transactions prior to loan issuance. With more
+    than one WORKERS the pass is partitioned by account.
+    """
+    dates = loan_dates()
+    if WORKERS > 1:
+        with stage('partitioned transaction pass') as s:
+            stream, trans_loans = partitioned_pass(dates, windows, WORKERS, keep)
+            s.rows = None if trans_loans is None else len(trans_loans)
+        return stream, trans_loans
+
+    stream = StreamAggregator(list(windows))
+    chunks = []
+    with stage('transaction pass') as s:
+        for chunk in read_trans_loans(dates, context=stream.context):
+            if keep:
+                chunks.append(chunk)
+            stream.update(chunk)
+        trans_loans = pd.concat(chunks, ignore_index=True) if keep else None
+        s.rows = None if trans_loans is None else len(trans_loans)
+    return stream, trans_loans
+
+
+# ### Create aggregate time-series variables
+# We will create aggregate time-series' for the recent interest rate as measured by the rate transactions and for the amount of concurrent loan applicants (rolling mean of past 6 months.
+# The series are kept by the TimeSeriesContext of the stream aggregator, see ts_context.py.
+
+def ts_features(stream, loan_ids=None):
+    """
+    Returns the interest rate and the rolling 90-day amount of
+    applicants at the loan date, indexed by loan_id.
+    """
+    with stage('ts features') as s:
+        ts_data = loan_dates().sort_values('date_loan')
+        if loan_ids is not None:
+            ts_data = ts_data[ts_data.loan_id.isin(loan_ids)]
+        #look up the rate and the amount of applicants as of the loan date
+        ts_data = ts_data[stream.context.observed(ts_data.date_loan)]
+        ts_data = ts_data.join(stream.context.lookup(ts_data.date_loan))
+        s.rows = len(ts_data)
+    return ts_data.set_index('loan_id')[['rate', 'applicants']]
+
+
+# ### Compute aggregations and combine
+# We first aggregate the transaction data to loan-level.
+# Then we merge with the static loan data and the time-series variables.
+
+def build_loan_data(windows=WINDOWS, suffixes=SUFFIXES, stream=None, loan_ids=None):
+    """
+    Builds the loan-level modelling data of credit_risk_datagen.py,
+    optionally only for the loans in loan_ids.
+    """
+    #the static stages first, so that each is recorded on its own and not within the transaction pass
+    loans = loan_features()
+    if stream is None:
+        stream, _ = trans_pass(tuple(tuple(window) for window in windows), False)
+    if loan_ids is not None:
+        loans = loans[loans.index.isin(loan_ids)]
+    loans = loans.join(ts_features(stream, loan_ids))
+    with stage('finalize aggregates') as s:
+        trans_agg = stream.aggregate(list(suffixes), loan_ids)
+        s.rows = len(trans_agg)
+    with stage('final merge') as s:
+        final = pd.merge(loans, trans_agg, left_index=True, right_index=True, suffixes=['','_trans'], how='left')
+        final = final[~final.index.duplicated(keep='first')]
+        s.rows = len(final)
+    return final
+
+
+def update_loan_data(windows=WINDOWS, suffixes=SUFFIXES, path='loan_data', state_path=STATE_PATH):
+    """
+    Incrementally updates the loan-level data stored as the table
+    artifact of path, see dump. The
+    stream aggregator of the previous run is kept in state_path,
+    only the transactions of loans that are not yet in the stored
+    data are read and their rows are appended. The rows of loans
+    already in the data are not recomputed. Without a stored state
+    the full data is built. Returns the updated data.
+    """
+    windows = tuple(tuple(window) for window in windows)
+    name, root = artifact_path(path)
+    if not (artifacts.versions(name, root) and os.path.exists(state_path)):
+        stream, _ = trans_pass(windows, False)
+        final = build_loan_data(windows, suffixes, stream)
+    else:
+        final = artifacts.load_table(name, root=root)
+        with open(state_path, 'rb') as file:
+            stream = pickle.load(file)
+        if not hasattr(stream, 'context'):
+            raise ValueError('Stored state {} has no time-series context, remove it to rebuild'.format(state_path))
+        if stream.windows != list(windows):
+            raise ValueError('Stored state was aggregated over windows {}, not {}'.format(
+                stream.windows, list(windows)))
+
+        dates = loan_dates()
+        new_dates = dates[~dates.loan_id.isin(final.index)]
+        if len(new_dates) == 0:
+            return final
+        for chunk in read_trans_loans(new_dates, context=stream.context):
+            stream.update(chunk)
+        rows = build_loan_data(windows, suffixes, stream, new_dates.loan_id.unique())
+        final = pd.concat([final, rows])
+
+    dump(final, path)
+    dump(stream, state_path)
+    return final
+
+
+def build_dfs_loans():
+    """
+    Builds the static loan data used for deep feature synthesis.
+    """
+    loans = loan_features()
+    loans = loans[~loans.index.duplicated()]
+    loans = loans.reset_index()
+    loans['loan_id'] = loans.loan_id.astype(int)
+    return loans
+
+
+def build_dfs_trans():
+    """
+    Builds the transaction data used for deep feature synthesis.
+    """
+    _, trans_loans = trans_pass(WINDOWS, True)
+    return trans_loans
+
+
+def from_args(argv):
+    """
+    Sets WORKERS if --workers=N is in argv and returns argv without it.
+    """
+    global WORKERS
+    rest = []
+    for arg in argv:
+        if arg.startswith('--workers='):
+            WORKERS = int(arg.split('=', 1)[1])
+        else:
+            rest.append(arg)
+    return rest
+
+
+def artifact_path(path):
+    #outputs named by a path are stored as the artifact of its basename, in the artifact store of its directory
+    return os.path.basename(path), os.path.join(os.path.dirname(path), artifacts.ARTIFACT_DIR)
+
+
+def dump(data, path):
+    """
+    Stores a DataFrame as a new version of the table artifact of path,
+    other objects, e.g. the aggregator state, are pickled to path.
+    """
+    with stage('dump ' + os.path.basename(path)) as s:
+        if isinstance(data, pd.DataFrame):
+            name, root = artifact_path(path)
+            artifacts.save_table(data, name, root)
+        else:
+            with open(path, 'wb') as file:
+                pickle.dump(data, file)
+        s.rows = len(data) if hasattr(data, '__len__') else None
+
+
+if __name__ == "__main__":
+    #build all outputs with a single pass over the transactions
+    args = from_args(instrument.from_args(sys.argv[1:]))
+    windows = WINDOWS
+    if len(args) == 2:
+        max_time = int(args[0])
+        min_time = int(args[1])
+        windows = ((max_time, min_time), (min_time, 0))
+
+    stream, trans_loans = trans_pass(windows, True)
+    dump(build_loan_data(windows, stream=stream), 'loan_data')
+    dump(build_dfs_loans(), 'dfs_data_loans')
+    dump(trans_loans, 'dfs_data_trans')
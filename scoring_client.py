@@ -0,0 +1,44 @@
+import json
+import http.client
+
+
+class ScoringClient:
+    """
+    Minimal client of the scoring service that keeps one
+    connection open for all requests.
+    """
+    def __init__(self, host='127.0.0.1', port=8080, timeout=10):
+        self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, method, path, payload=None):
+        body = None if payload is None else json.dumps(payload)
+        headers = {} if payload is None else {'Content-Type': 'application/json'}
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        data = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError('{}: {}'.format(response.status, data.get('error')))
+        return data
+
+    def score(self, rows):
+        """
+        Returns the default probabilities of a list of feature rows.
+        """
+        return self._request('POST', '/score', {'rows': rows})['probability']
+
+    def score_features(self, features):
+        """
+        Returns the default probability of one loan given as a dict
+        of feature name to value.
+        """
+        return self._request('POST', '/score', {'features': features})['probability'][0]
+
+    def metrics(self):
+        return self._request('GET', '/metrics')
+
+    def health(self):
+        #status and feature names of the served model
+        return self._request('GET', '/health')
+
+    def close(self):
+        self.connection.close()
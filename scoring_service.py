@@ -0,0 +1,214 @@
+# # ONLINE SCORING SERVICE
+# Serves default probabilities of a persisted model over HTTP. Concurrent requests are collected
+# into micro-batches, so that the model is called once per batch with a single predict_proba.
+#
+#   python scoring_service.py bk/artifacts/credit_ensemble --port 8080 --compiled
+#
+# POST /score   {"rows": [[...], ...]}  or  {"features": {"amount": ..., ...}}
+# GET  /metrics  request and batch counts with p50/p99 latencies in milliseconds
+import os
+import asyncio
+import argparse
+import json
+import pickle
+import time
+from collections import deque
+import numpy as np
+
+
+def load_model(path):
+    """
+    Loads a model artifact directory of artifacts.py, with the feature
+    names of its schema, or a pickled model. The feature names of a
+    pickled model are the columns_ it was fitted on, if recorded.
+    """
+    if os.path.isdir(path):
+        import artifacts
+        return artifacts.read_model(path)
+    with open(path, 'rb') as file:
+        model = pickle.load(file, encoding="latin1")
+    return model, getattr(model, 'columns_', None)
+
+
+class BatchScorer:
+    """
+    Collects rows from concurrent score calls into batches of at most
+    max_batch rows, waiting at most max_delay seconds for a batch to
+    fill, and scores each batch with one predict_proba call in a
+    worker thread. Rows of a width other than the n_features of the
+    model are rejected when parsed, so that a batch always stacks.
+    """
+    def __init__(self, model, columns=None, max_batch=256, max_delay=0.002, window=10000):
+        self.model = model
+        self.columns = columns
+        self.n_features = len(columns) if columns is not None else getattr(model, 'n_features_in_', None)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.rows = 0
+
+    def to_rows(self, payload):
+        if not isinstance(payload, dict):
+            raise ValueError('Expected a JSON object with rows or features')
+        if 'features' in payload:
+            if self.columns is None:
+                raise ValueError('The model has no feature names, send rows instead')
+            features = payload['features']
+            return np.array([[features[col] for col in self.columns]], dtype=float)
+        rows = np.atleast_2d(np.array(payload['rows'], dtype=float))
+        if rows.ndim != 2 or (self.n_features is not None and rows.shape[1] != self.n_features):
+            raise ValueError('Expected rows of {} features, got shape {}'.format(self.n_features, rows.shape))
+        return rows
+
+    async def score(self, rows):
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((rows, future))
+        probs = await future
+        self.latencies.append(time.perf_counter() - start)
+        self.requests += 1
+        return probs
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            size = len(batch[0][0])
+            deadline = loop.time() + self.max_delay
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                size += len(item[0])
+
+            #requests of clients that disconnected while waiting are dropped
+            batch = [(rows, future) for rows, future in batch if not future.cancelled()]
+            if batch:
+                await self.score_batch(loop, batch)
+
+    async def score_batch(self, loop, batch):
+        """
+        Scores a batch with one predict_proba call. When the call fails,
+        the requests of the batch are scored one by one, so that only
+        the requests that fail themselves get the error.
+        """
+        try:
+            X = np.vstack([rows for rows, _ in batch])
+            probs = await loop.run_in_executor(None, self.predict, X)
+        except Exception as error:
+            if len(batch) > 1:
+                for item in batch:
+                    await self.score_batch(loop, [item])
+            elif not batch[0][1].done():
+                batch[0][1].set_exception(error)
+            return
+        self.batches += 1
+        self.rows += len(X)
+        i = 0
+        for rows, future in batch:
+            if not future.done():
+                future.set_result(probs[i:i + len(rows)].tolist())
+            i += len(rows)
+
+    def predict(self, X):
+        return self.model.predict_proba(X)[:,1]
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch_rows': self.rows / self.batches if self.batches else 0,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None
+        }
+
+
+async def handle(scorer, reader, writer):
+    #HTTP/1.1 with keep-alive, one request at a time per connection
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            headers = {}
+            while True:
+                header = await reader.readline()
+                if header in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = header.decode('latin1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            status = '200 OK'
+            close = headers.get('connection', '').lower() == 'close'
+            try:
+                parts = line.decode('latin1').split()
+                if len(parts) != 3 or not headers.get('content-length', '0').isdigit():
+                    #the next request cannot be found after a malformed one
+                    close = True
+                    raise ValueError('malformed request')
+                method, path, _ = parts
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if method == 'POST' and path == '/score':
+                    rows = scorer.to_rows(json.loads(body))
+                    response = {'probability': await scorer.score(rows)}
+                elif method == 'GET' and path == '/metrics':
+                    response = scorer.metrics()
+                elif method == 'GET' and path == '/health':
+                    response = {'status': 'ok', 'columns': scorer.columns}
+                else:
+                    status, response = '404 Not Found', {'error': 'unknown route'}
+            except (ConnectionError, asyncio.IncompleteReadError):
+                raise
+            except (ValueError, KeyError) as error:
+                status, response = '400 Bad Request', {'error': str(error)}
+            except Exception as error:
+                #e.g. a failing model, the client always gets a status
+                status, response = '500 Internal Server Error', {'error': repr(error)}
+
+            content = json.dumps(response).encode()
+            writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'
+                         .format(status, len(content)).encode() + content)
+            await writer.drain()
+            if close:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(model, columns=None, host='127.0.0.1', port=8080, max_batch=256, max_delay=0.002):
+    scorer = BatchScorer(model, columns, max_batch, max_delay)
+    batcher = asyncio.ensure_future(scorer.run())
+    server = await asyncio.start_server(lambda r, w: handle(scorer, r, w), host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve default probabilities of a persisted model.')
+    parser.add_argument('model', help='model artifact or pickled model, e.g. bk/artifacts/credit_ensemble')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch', type=int, default=256, help='maximum rows per predict_proba call')
+    parser.add_argument('--max-delay', type=float, default=2, help='milliseconds to wait for a batch to fill')
+    parser.add_argument('--compiled', action='store_true', help='score with the NumPy arrays of compiled.py')
+    args = parser.parse_args()
+
+    model, columns = load_model(args.model)
+    if args.compiled:
+        from compiled import compile_model
+        model = compile_model(model)
+    asyncio.run(serve(model, columns, args.host, args.port, args.max_batch, args.max_delay / 1000))
@@ -0,0 +1,131 @@
+import pandas as pd
+import numpy as np
+from instrument import stage
+
+# statistics produced for each time window, in the same order as the original aggregate()
+AGG_COLUMNS = ['balance_min', 'balance_mean', 'balance_max', 'c_deposit_sum', 'c_withdr_sum',
+               'sanc_max', 'rate_min', 'rate_mean', 'rate_max', 'transactions_sum',
+               'net_cdeposit_sum', 'net_bdeposit_sum', 'net_bdeposit_max', 'age_mean', 'neg_bal']
+
+INT_COLUMNS = ['c_deposit_sum', 'c_withdr_sum', 'sanc_max', 'transactions_sum', 'neg_bal']
+
+# partial statistics reduced over the rows of each window
+PARTIALS = {'balance': ['min', 'max', 'sum'], 'balance_start': ['first'],
+            'c_deposit': ['sum'], 'c_withdr': ['sum'], 'sanc': ['max'],
+            'rate': ['min', 'max', 'sum', 'count'], 'transactions': ['sum'],
+            'net_cdeposit': ['sum'], 'net_bdeposit': ['sum', 'max'], 'age': ['sum']}
+
+# how the partials of separate chunks are combined
+COMBINE = {'min': 'min', 'max': 'max', 'sum': 'sum', 'count': 'sum', 'first': 'first'}
+
+
+def window_partials(data, windows):
+    """
+    Computes partial per-loan statistics for every (max, min) window
+    in one groupby pass. The rows outside a window are masked with NaN,
+    so all windows are reduced together without filtering the data.
+    Partials of several chunks can be combined with combine_partials.
+    """
+    days = (data.date_loan - data.date).dt.days.values
+    amount = data.amount_trans.values.astype(float)
+    balance = data.balance.values.astype(float)
+    c_deposit = data.c_deposit.values.astype(float)
+    c_withdr = data.c_withdr.values.astype(float)
+
+    #transaction-level variables shared by all windows
+    base = {
+        'balance': balance,
+        'balance_start': balance - amount,
+        'c_deposit': c_deposit,
+        'c_withdr': c_withdr,
+        'sanc': data.sanc.values.astype(float),
+        'rate': data.rate.values.astype(float),
+        'transactions': np.ones(len(data)),
+        'net_cdeposit': (c_deposit - c_withdr) * amount,
+        'net_bdeposit': (data.b_deposit.values.astype(float) - data.b_withdr.values) * amount,
+        'age': days.astype(float)
+    }
+
+    masked = {}
+    aggs = {}
+    for i, (time_window_max, time_window_min) in enumerate(windows):
+        mask = (days < time_window_max) & (days > time_window_min)
+        for col, values in base.items():
+            masked['{}_{}'.format(i, col)] = np.where(mask, values, np.nan)
+            aggs['{}_{}'.format(i, col)] = PARTIALS[col]
+
+    masked = pd.DataFrame(masked, index=data.index)
+    masked['loan_id'] = data.loan_id.values
+    partials = masked.groupby('loan_id', sort=False).agg(aggs)
+    partials.columns = ['_'.join(col) for col in partials.columns.values]
+    return partials
+
+
+def combine_partials(partials):
+    """
+    Combines a list of window partials, in the order the
+    underlying rows were read, into a single partial frame.
+    """
+    if len(partials) == 1:
+        return partials[0]
+    combine = {col: COMBINE[col.rsplit('_', 1)[1]] for col in partials[0].columns}
+    return pd.concat(partials).groupby(level=0, sort=False).agg(combine)
+
+
+def finalize_partials(partials, windows, suffixes=None):
+    """
+    Turns window partials into the loan-level aggregates of
+    aggregate(), with one block of columns per window. The
+    index holds the loans with transactions in the first window.
+    """
+    if suffixes is None:
+        suffixes = ['_{}_{}'.format(*window) for window in windows]
+    partials = partials.sort_index()
+
+    blocks = []
+    for i in range(len(windows)):
+        p = partials[[col for col in partials.columns if col.startswith('{}_'.format(i))]]
+        p.columns = [col.split('_', 1)[1] for col in p.columns]
+        count = p.transactions_sum
+        first = p.balance_start_first
+
+        agg = pd.DataFrame(index=p.index)
+        agg['balance_min'] = np.fmin(p.balance_min, first)
+        agg['balance_mean'] = p.balance_sum / count
+        agg['balance_max'] = np.fmax(p.balance_max, first)
+        agg['c_deposit_sum'] = p.c_deposit_sum
+        agg['c_withdr_sum'] = p.c_withdr_sum
+        agg['sanc_max'] = p.sanc_max
+        agg['rate_min'] = p.rate_min
+        agg['rate_mean'] = p.rate_sum / p.rate_count.where(p.rate_count > 0)
+        agg['rate_max'] = p.rate_max
+        agg['transactions_sum'] = count
+        agg['net_cdeposit_sum'] = p.net_cdeposit_sum
+        agg['net_bdeposit_sum'] = p.net_bdeposit_sum
+        agg['net_bdeposit_max'] = p.net_bdeposit_max
+        agg['age_mean'] = p.age_sum / count
+        agg['neg_bal'] = (agg.balance_min < 0).astype(int)
+
+        #loans without transactions in the window are missing, as after the left join
+        agg = agg[AGG_COLUMNS].where(count > 0)
+        if i == 0:
+            agg = agg[count > 0]
+            agg[INT_COLUMNS] = agg[INT_COLUMNS].astype(int)
+        agg.columns = [col + suffixes[i] for col in agg.columns]
+        blocks.append(agg)
+
+    trans_agg = blocks[0].join(blocks[1:]) if len(blocks) > 1 else blocks[0]
+    trans_agg.index.name = 'loan_id'
+    return trans_agg
+
+
+def aggregate_windows(data, windows, suffixes=None):
+    """
+    Aggregates the transaction data to loan-level for a list of
+    (time_window_max, time_window_min) windows in a single pass.
+    Gives the same columns as joining aggregate() over the windows,
+    with suffixes[i] appended to the columns of window i.
+    """
+    with stage('aggregate windows') as s:
+        s.rows = len(data)
+        return finalize_partials(window_partials(data, windows), windows, suffixes)
@@ -0,0 +1,177 @@
+import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import berka_cache
+from berka_cache import read_chunks
+from instrument import stage
+from trans_agg import window_partials, combine_partials, finalize_partials
+from ts_context import TimeSeriesContext
+
+# rows of trans.asc read at a time
+CHUNKSIZE = 500000
+
+# dummy columns generated from the combined k_symbol/operation category,
+# card and cash withdrawals are combined to one
+K_SYMBOLS = {' ': 'b_withdr', 'POJISTNE': 'insur', 'PREVOD Z UCTU': 'b_deposit',
+             'SANKC. UROK': 'sanc', 'SIPO': 'hhold', 'UROK': 'interest',
+             'VKLAD': 'c_deposit', 'VYBER': 'c_withdr', 'VYBER KARTOU': 'c_withdr'}
+
+TRANS_COLUMNS = ['loan_id', 'date', 'date_loan', 'amount_trans', 'balance', 'b_withdr',
+                 'insur', 'b_deposit', 'sanc', 'hhold', 'interest', 'c_deposit', 'c_withdr']
+
+
+def prep_trans(trans_loans, keys=('loan_id', 'date', 'date_loan')):
+    """
+    Takes in transactions merged with the loan dates and
+    returns the transaction variables used for modelling. The
+    dummy columns are fixed, so that the result does not depend
+    on which categories happen to appear in the data. The keys
+    are the identifying columns kept in front of the variables.
+    """
+    #drop transactions of payments for statements
+    trans_loans = trans_loans[trans_loans.k_symbol != 'SLUZBY']
+
+    #combine the k_symbol and operation into one categorical variable
+    k_symbol = np.where(trans_loans.k_symbol.isna(), trans_loans.operation.map(K_SYMBOLS),
+                        trans_loans.k_symbol.map(K_SYMBOLS))
+
+    prep = trans_loans[list(keys) + ['amount', 'balance']]
+    prep = prep.rename(columns={'amount': 'amount_trans'})
+    for col in TRANS_COLUMNS[5:]:
+        prep[col] = (k_symbol == col).astype(np.uint8)
+    return prep
+
+
+def read_trans_loans(loan_dates, chunksize=CHUNKSIZE, context=None, path=None):
+    """
+    Reads the parsed transactions in chunks of chunksize rows and
+    yields the prepped transactions prior to loan issuance for
+    each chunk. Only the loan accounts are merged with the loan
+    dates, so the full merge is never materialized. The source
+    transactions of the loan accounts are passed to the
+    TimeSeriesContext context before the merge. path is a cache
+    of part of the transactions, see berka_cache.split_cache.
+    """
+    accounts = loan_dates.account_id.unique()
+    if context is not None:
+        context.add_loans(loan_dates)
+    reader = read_chunks('trans', chunksize,
+                         ['account_id', 'date', 'operation', 'amount', 'balance', 'k_symbol'],
+                         where=('account_id', accounts), path=path)
+    while True:
+        with stage('read trans') as s:
+            trans = next(reader, None)
+            s.rows = 0 if trans is None else len(trans)
+        if trans is None:
+            break
+        with stage('merge loan dates') as s:
+            if context is not None:
+                context.update(trans)
+            trans_loans = pd.merge(loan_dates, trans, on='account_id')
+
+            #filter to transactions prior to loan issuance
+            trans_loans = trans_loans[trans_loans.date < trans_loans.date_loan]
+            s.rows = len(trans_loans)
+        if len(trans_loans) > 0:
+            with stage('prep trans'):
+                prep = prep_trans(trans_loans)
+            yield prep
+
+
+class StreamAggregator:
+    """
+    Collects the loan-level transaction aggregates from transaction
+    chunks, so that only per-loan statistics are kept in memory. The
+    time-series variables are collected by context, which is fed the
+    source transactions by read_trans_loans.
+    """
+    def __init__(self, windows):
+        self.windows = windows
+        self.partials = None
+        self.context = TimeSeriesContext()
+
+    def update(self, chunk):
+        with stage('aggregate') as s:
+            s.rows = len(chunk)
+            return self._update(chunk)
+
+    def _update(self, chunk):
+        #create interest-rate variable for interest transactions
+        chunk = chunk.assign(rate=(chunk.amount_trans * chunk.interest) / (chunk.balance - chunk.amount_trans))
+
+        partials = window_partials(chunk, self.windows)
+        if self.partials is not None:
+            partials = combine_partials([self.partials, partials])
+        self.partials = partials
+        return self
+
+    def aggregate(self, suffixes=None, loan_ids=None):
+        partials = self.partials
+        if loan_ids is not None:
+            partials = partials[partials.index.isin(loan_ids)]
+        return finalize_partials(partials, self.windows, suffixes)
+
+    @classmethod
+    def merge(cls, streams):
+        """
+        Merges the aggregators of disjoint sets of loan accounts.
+        """
+        merged = cls(streams[0].windows)
+        partials = [stream.partials for stream in streams if stream.partials is not None]
+        merged.partials = pd.concat(partials) if partials else None
+        merged.context = TimeSeriesContext.merge([stream.context for stream in streams])
+        return merged
+
+    def rates(self):
+        return self.context.rates()
+
+    def applicants(self):
+        return self.context.applicants()
+
+
+def partition_loans(loan_dates, n_parts):
+    """
+    Splits the loan dates into n_parts tables by a hash of the account,
+    so that all loans and transactions of an account are in one part.
+    """
+    part = pd.util.hash_array(loan_dates.account_id.values) % n_parts
+    return [loan_dates[part == i] for i in range(n_parts)]
+
+
+def _pass_partition(loan_dates, windows, keep, chunksize, data_dir, cache_dir, path):
+    #the cache location may be changed in the parent, e.g. by the benchmark
+    berka_cache.DATA_DIR, berka_cache.CACHE_DIR = data_dir, cache_dir
+    stream = StreamAggregator(list(windows))
+    chunks = []
+    for chunk in read_trans_loans(loan_dates, chunksize, context=stream.context, path=path):
+        if keep:
+            chunks.append(chunk)
+        stream.update(chunk)
+    return stream, (pd.concat(chunks, ignore_index=True) if chunks else None)
+
+
+def partitioned_pass(loan_dates, windows, workers, keep=False, chunksize=CHUNKSIZE):
+    """
+    Runs the transaction pass on a pool of workers processes, one per
+    hash partition of the loan accounts. The transaction cache is split
+    once by partition, so that each worker reads only the rows of its
+    accounts, and merges, preps and aggregates them. The results are
+    concatenated. Returns the merged stream aggregator and, if keep is
+    True, the prepped transactions prior to loan issuance.
+    """
+    parts = [part for part in partition_loans(loan_dates, workers) if len(part)]
+    if berka_cache.pa is not None:
+        with stage('split trans cache'):
+            paths = berka_cache.split_cache('trans', 'account_id', [part.account_id.unique() for part in parts])
+    else:
+        #without pyarrow every worker parses the .asc file and filters its accounts
+        paths = [None] * len(parts)
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(_pass_partition, part, windows, keep, chunksize,
+                               berka_cache.DATA_DIR, berka_cache.CACHE_DIR, path)
+                   for part, path in zip(parts, paths)]
+        results = [future.result() for future in futures]
+    stream = StreamAggregator.merge([result[0] for result in results])
+    chunks = [result[1] for result in results if result[1] is not None]
+    trans_loans = pd.concat(chunks, ignore_index=True) if keep and chunks else None
+    return stream, trans_loans
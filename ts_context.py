@@ -0,0 +1,161 @@
+import numpy as np
+import pandas as pd
+
+# rolling window of the amount of concurrent loan applicants, in days
+APPLICANT_WINDOW = 90
+
+
+def day_numbers(dates):
+    #days since the epoch, the index of the daily arrays
+    return np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+
+
+class TimeSeriesContext:
+    """
+    Market-level time-series variables at the loan dates: the interest
+    rate index and the rolling amount of loan applicants. Computed from
+    the source transactions of the loan accounts, each transaction seen
+    once however many loans and clients share the account, and from
+    the loans. The series are cached as arrays indexed by day and
+    looked up as of a date by binary search, so that new loans and
+    accounts only add their own rows.
+    """
+    def __init__(self):
+        self.loans = pd.DataFrame({'loan_id': [], 'account_id': [], 'date_loan': [], 'rows': []})
+        #interest transactions and the first transaction date of each account
+        self.interest = pd.DataFrame({'account_id': [], 'day': [], 'rate': []})
+        self.first_day = pd.Series(dtype=np.int64)
+        self.accounts = set()
+        self._new_accounts = set()
+        self._series = None
+
+    @classmethod
+    def merge(cls, contexts):
+        """
+        Merges the contexts of disjoint sets of loan accounts.
+        """
+        merged = cls()
+        for context in contexts:
+            if len(context.loans):
+                merged.loans = pd.concat([merged.loans, context.loans], ignore_index=True) \
+                    if len(merged.loans) else context.loans
+            if len(context.interest):
+                merged.interest = pd.concat([merged.interest, context.interest], ignore_index=True) \
+                    if len(merged.interest) else context.interest
+            if len(context.first_day):
+                merged.first_day = pd.concat([merged.first_day, context.first_day]) \
+                    if len(merged.first_day) else context.first_day
+            merged.accounts |= context.accounts
+        return merged
+
+    def add_loans(self, loan_dates):
+        """
+        Adds the loans of a loan_dates table, with one row per client of
+        the loan account. The transactions of accounts already known are
+        not added again.
+        """
+        loans = loan_dates.groupby(['loan_id', 'account_id', 'date_loan']).size().rename('rows').reset_index()
+        loans = loans[~loans.loan_id.isin(self.loans.loan_id)]
+        self.loans = pd.concat([self.loans, loans], ignore_index=True) if len(self.loans) else loans
+        self._new_accounts = set(loans.account_id) - self.accounts
+        self.accounts |= self._new_accounts
+        self._series = None
+        return self
+
+    def update(self, trans):
+        """
+        Takes in a chunk of source transactions of the loan accounts.
+        """
+        trans = trans[trans.account_id.isin(self._new_accounts) & (trans.k_symbol != 'SLUZBY')]
+        days = pd.Series(day_numbers(trans.date), index=trans.index)
+
+        first_day = days.groupby(trans.account_id.values).min()
+        self.first_day = pd.concat([self.first_day, first_day]).groupby(level=0).min() \
+            if len(self.first_day) else first_day
+
+        interest = trans.k_symbol == 'UROK'
+        rows = trans[interest]
+        amount = rows.amount.astype(float)
+        rate = amount / (rows.balance.astype(float) - amount)
+        interest = pd.DataFrame({'account_id': rows.account_id.values, 'day': days[interest].values,
+                                 'rate': rate.values})
+        self.interest = pd.concat([self.interest, interest], ignore_index=True) if len(self.interest) \
+            else interest
+        self._series = None
+        return self
+
+    def series(self):
+        """
+        Returns the cached daily arrays: the days and values of the
+        interest rate index, and the first day and daily values of the
+        rolling amount of applicants.
+        """
+        if self._series is not None:
+            return self._series
+        loan_days = day_numbers(self.loans.date_loan)
+
+        #interest rate by day, weighted by the rows of each loan and client prior to the loan date
+        events = pd.merge(self.interest, pd.DataFrame({'account_id': self.loans.account_id.values,
+                                                       'loan_day': loan_days, 'rows': self.loans.rows.values}),
+                          on='account_id')
+        #summed in a fixed order, so that the rates do not depend on the order the accounts were read in
+        events = events[events.day < events.loan_day].sort_values(['day', 'account_id'], kind='stable')
+        valid = events.rate.notna()
+        stats = pd.DataFrame({'sum': (events.rate * events.rows).where(valid, 0),
+                              'count': events.rows.where(valid, 0),
+                              'day': events.day}).groupby('day').sum()
+        rate_days, rates = stats.index.values.astype(np.int64), (stats['sum'] / stats['count']).values
+
+        #loans with transactions prior to the loan date, counted on the loan date
+        first = self.first_day.reindex(self.loans.account_id).values
+        counted = loan_days[first < loan_days]
+        if len(counted):
+            start = counted.min()
+            counts = np.bincount(counted - start, minlength=counted.max() - start + 1)
+            #sum over the window of days before each day
+            cum = np.r_[0, np.cumsum(counts)]
+            days = np.arange(len(counts))
+            applicants = np.full(len(counts), np.nan)
+            past = days >= APPLICANT_WINDOW
+            applicants[past] = cum[days[past]] - cum[days[past] - APPLICANT_WINDOW]
+        else:
+            start, applicants = 0, np.empty(0)
+
+        self._series = {'rate_days': rate_days, 'rates': rates, 'applicant_start': start,
+                        'applicants': applicants}
+        return self._series
+
+    def observed(self, dates):
+        """
+        Returns the mask of the dates within the days of the applicants.
+        """
+        series = self.series()
+        position = day_numbers(dates) - series['applicant_start']
+        return (position >= 0) & (position < len(series['applicants']))
+
+    def lookup(self, dates):
+        """
+        Returns the interest rate as of each date, the last rate on or
+        before it, and the amount of applicants over the APPLICANT_WINDOW
+        days before it.
+        """
+        series = self.series()
+        days = day_numbers(dates)
+        position = np.searchsorted(series['rate_days'], days, side='right') - 1
+        rate = np.where(position >= 0, series['rates'][np.maximum(position, 0)], np.nan) \
+            if len(series['rates']) else np.full(len(days), np.nan)
+
+        observed = self.observed(dates)
+        applicants = np.full(len(days), np.nan)
+        applicants[observed] = series['applicants'][days[observed] - series['applicant_start']]
+        return pd.DataFrame({'rate': rate, 'applicants': applicants}, index=getattr(dates, 'index', None))
+
+    def rates(self):
+        series = self.series()
+        return pd.Series(series['rates'], index=pd.to_datetime(series['rate_days'], unit='D'), name='rate')
+
+    def applicants(self):
+        #rolling sum of applicants prior to the loan date
+        series = self.series()
+        index = pd.to_datetime(series['applicant_start'] + np.arange(len(series['applicants'])), unit='D')
+        return pd.Series(series['applicants'], index=index)
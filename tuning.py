@@ -0,0 +1,236 @@
+# # BUDGET-AWARE HYPERPARAMETER SEARCH
+# Successive halving and hyperband for the boosting pipelines of credit_models.py. Candidates are sampled
+# from a parameter grid as in RandomizedSearchCV and cross-validated with a small number of trees. The best
+# 1/factor of them survive to the next rung, where their fitted models are warm started with more trees
+# instead of being refit from zero. The fits of a rung run in a process pool and the search is checkpointed,
+# so that an interrupted search resumes where it stopped.
+#
+#   search = HalvingSearch(create_pipeline(GradientBoostingClassifier(), dummy_mask), param_grid,
+#                          cv=kfold, n_jobs=-1, random_state=1)
+#   search.fit(X, y)
+#   search.best_params_
+import os
+import time
+import pickle
+import numpy as np
+import pandas as pd
+from concurrent.futures import as_completed
+from joblib import hash as data_hash
+from sklearn.base import clone, is_classifier
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import ParameterSampler, check_cv
+import fit_pool
+
+# checkpoints of the searches, keyed by the estimator, the candidates, the data and the folds
+CHECKPOINT_DIR = 'bk/tuning'
+
+# seconds between checkpoints within a rung, a rung is always checkpointed when it completes
+CHECKPOINT_EVERY = 60
+
+def final_estimator(model):
+    return getattr(model, '_final_estimator', model)
+
+
+def _fit_rung(model, params, warm, train, test, scorer):
+    """
+    Grows a fitted model, or fits a new one, to the resource of params
+    on the train rows and scores it on the test rows. A model that
+    stopped early at a previous rung is not grown any further.
+    """
+    clf = final_estimator(model)
+    n_fitted = getattr(clf, 'n_estimators_', None)
+    stopped = n_fitted is not None and n_fitted < clf.n_estimators
+    if not stopped:
+        #a warm start would restart the validation loss history of early stopping,
+        #so models with early stopping are refit until they stop
+        model.set_params(**params, **{warm: getattr(clf, 'n_iter_no_change', None) is None})
+        model.fit(*fit_pool.rows(train))
+    return model, scorer(model, *fit_pool.rows(test))
+
+
+class HalvingSearch:
+    """
+    Successive halving, or hyperband, search over the parameters of a
+    boosting model with the number of trees as the budget. The rungs
+    select the number of trees, so early stopping is best left out of
+    the grid: a candidate with n_iter_no_change set is refit from zero
+    at every rung instead of warm started.
+
+    estimator = unfitted model, e.g. a create_pipeline of a GradientBoostingClassifier
+    param_distributions = grid or distributions of the parameters, as in RandomizedSearchCV
+    n_candidates = number of candidates of successive halving, ignored by hyperband
+    resource = parameter of the number of trees, its largest value in the grid is the max budget
+    min_resource = least number of trees of the first rung
+    factor = 1/factor of the candidates survive each rung, with factor times the trees
+    hyperband = run the hyperband brackets of successive halving instead of one
+    """
+    def __init__(self, estimator, param_distributions, n_candidates=100, resource='clf__n_estimators',
+                 max_resource=None, min_resource=10, factor=3, hyperband=False, cv=None,
+                 scoring='neg_log_loss', n_jobs=None, random_state=None, refit=True,
+                 checkpoint_dir=CHECKPOINT_DIR, verbose=0):
+        self.estimator = estimator
+        self.param_distributions = param_distributions
+        self.n_candidates = n_candidates
+        self.resource = resource
+        self.max_resource = max_resource
+        self.min_resource = min_resource
+        self.factor = factor
+        self.hyperband = hyperband
+        self.cv = cv
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.refit = refit
+        self.checkpoint_dir = checkpoint_dir
+        self.verbose = verbose
+
+    def _max_resource(self):
+        if self.max_resource is not None:
+            return self.max_resource
+        grids = self.param_distributions if isinstance(self.param_distributions, list) \
+            else [self.param_distributions]
+        values = [value for grid in grids for value in grid.get(self.resource, [])]
+        if not values:
+            raise ValueError('Set max_resource or give {} values in the grid'.format(self.resource))
+        return max(values)
+
+    def _grid(self):
+        #the number of trees is the budget and not searched
+        if isinstance(self.param_distributions, list):
+            return [{k: v for k, v in grid.items() if k != self.resource} for grid in self.param_distributions]
+        return {k: v for k, v in self.param_distributions.items() if k != self.resource}
+
+    def brackets(self, n_available=None):
+        """
+        Returns the brackets of the search as lists of rungs of
+        (number of candidates, number of trees). A bracket starts with
+        at most n_available candidates, the size of a discrete grid.
+        """
+        r_max = self._max_resource()
+        s_max = int(np.floor(np.log(r_max / self.min_resource) / np.log(self.factor) + 1e-9))
+        if self.hyperband:
+            sizes = [(int(np.ceil((s_max + 1) / (s + 1) * self.factor ** s)), s) for s in range(s_max, -1, -1)]
+        else:
+            sizes = [(self.n_candidates, None)]
+        brackets = []
+        for n, s in sizes:
+            if n_available is not None:
+                n = min(n, n_available)
+            if s is None:
+                s = min(s_max, int(np.floor(np.log(n) / np.log(self.factor) + 1e-9)))
+            brackets.append([(int(np.ceil(n / self.factor ** i)),
+                              max(1, int(round(r_max * self.factor ** (i - s))))) for i in range(s + 1)])
+        return brackets
+
+    def _checkpoint_path(self, X, y, folds, candidates, brackets):
+        if self.checkpoint_dir is None:
+            return None
+        key = data_hash((clone(self.estimator), candidates, brackets, self.resource, self.scoring,
+                         X, y, folds))
+        return os.path.join(self.checkpoint_dir, key)
+
+    def _save(self, path, state):
+        if path is None:
+            return
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        #write and rename, so that an interruption does not corrupt the checkpoint
+        with open(path + '.tmp', 'wb') as file:
+            pickle.dump(state, file)
+        os.replace(path + '.tmp', path)
+
+    def fit(self, X, y):
+        cv = check_cv(self.cv, y, classifier=is_classifier(self.estimator))
+        folds = list(cv.split(X, y))
+        scorer = check_scoring(self.estimator, self.scoring)
+        candidates = list(ParameterSampler(self._grid(), sum(bracket[0][0] for bracket in self.brackets()),
+                                           random_state=self.random_state))
+        #a discrete grid smaller than the brackets is sampled whole and shared by the brackets
+        brackets = self.brackets(len(candidates))
+
+        path = self._checkpoint_path(X, y, folds, candidates, brackets)
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as file:
+                state = pickle.load(file)
+        else:
+            #scores of each (bracket, rung, candidate) by fold, latest fitted model of each (bracket, candidate) by fold
+            state = {'scores': {}, 'models': {}}
+        scores, models = state['scores'], state['models']
+        warm = self.resource.rsplit('__', 1)[0] + '__warm_start' if '__' in self.resource else 'warm_start'
+
+        pool = fit_pool.data_pool(X, y, self.n_jobs)
+        results = []
+        try:
+            first = 0
+            for b, bracket in enumerate(brackets):
+                alive = [c % len(candidates) for c in range(first, first + bracket[0][0])]
+                first += bracket[0][0]
+                for i, (n, r) in enumerate(bracket):
+                    tasks = [(c, f) for c in alive for f in range(len(folds))
+                             if scores.get((b, i, c), {}).get(f) is None]
+                    if tasks and self.verbose:
+                        print('Bracket {} rung {}: {} candidates with {} trees, {} fits'.format(
+                            b, i, len(alive), r, len(tasks)))
+                    self._run(tasks, b, i, r, warm, candidates, folds, scorer, state, path, pool)
+
+                    for c in alive:
+                        fold_scores = [scores[(b, i, c)][f] for f in range(len(folds))]
+                        results.append(dict(candidates[c], bracket=b, rung=i, candidate=c,
+                                            **{self.resource: r, 'mean_test_score': np.mean(fold_scores),
+                                               'std_test_score': np.std(fold_scores)}))
+                    if i + 1 < len(bracket):
+                        ranked = sorted(alive, key=lambda c: -np.mean(list(scores[(b, i, c)].values())))
+                        alive = ranked[:bracket[i + 1][0]]
+                        for c in ranked[bracket[i + 1][0]:]:
+                            models.pop((b, c), None)
+                self._save(path, state)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        self.cv_results_ = pd.DataFrame(results)
+        #the candidates of the last rung of every bracket are fitted with the full budget
+        last = self.cv_results_[self.cv_results_['rung'] == self.cv_results_.groupby('bracket')['rung']
+                                .transform('max')]
+        best = last.loc[last['mean_test_score'].idxmax()]
+        self.best_index_ = best.name
+        self.best_score_ = best['mean_test_score']
+        self.best_params_ = dict(candidates[int(best['candidate'])], **{self.resource: int(best[self.resource])})
+        if self.refit:
+            self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_).fit(X, y)
+        return self
+
+    def _run(self, tasks, b, i, r, warm, candidates, folds, scorer, state, path, pool):
+        """
+        Runs the fits of one rung and records their scores and models
+        in state, checkpointing every CHECKPOINT_EVERY seconds.
+        """
+        scores, models = state['scores'], state['models']
+
+        def submit(c, f):
+            model = models.get((b, c), {}).get(f)
+            if model is None:
+                model = clone(self.estimator).set_params(**candidates[c])
+            train, test = folds[f]
+            if pool is None:
+                return _fit_rung(model, {self.resource: r}, warm, train, test, scorer)
+            return pool.submit(_fit_rung, model, {self.resource: r}, warm, train, test, scorer)
+
+        def record(c, f, result):
+            model, score = result
+            models.setdefault((b, c), {})[f] = model
+            scores.setdefault((b, i, c), {})[f] = score
+
+        saved = time.time()
+        if pool is None:
+            for c, f in tasks:
+                record(c, f, submit(c, f))
+                if time.time() - saved > CHECKPOINT_EVERY:
+                    self._save(path, state)
+                    saved = time.time()
+            return
+        futures = {submit(c, f): (c, f) for c, f in tasks}
+        for future in as_completed(futures):
+            record(*futures[future], future.result())
+            if time.time() - saved > CHECKPOINT_EVERY:
+                self._save(path, state)
+                saved = time.time()